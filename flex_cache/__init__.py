@@ -1,13 +1,18 @@
 from .rediscache import RedisCache
+from .asyncrediscache import AsyncRedisCache
 from .memcache import MemCache
 from .diskcache import DiskCache
 from .nocache import NoCache
+from .tieredcache import TieredCache
+from .serializers import serialization_options, is_binary
+from .refresh import RefreshAheadScheduler
 
 DEFAULT_SETTINGS = {
     'type': 'MemCache',
     'prefix': 'rc',
     'serializer': 'json.dumps',
     'deserializer': 'json.loads',
+    'serialization': None,  # json, pickle or msgpack preset - overrides serializer/deserializer, see serializers.py
     'diskcache_directory': None,  # diskcache will default to os specific temp dir
     'redis_host': 'localhost',
     'redis_port': 6379,
@@ -17,6 +22,12 @@ DEFAULT_SETTINGS = {
     'redis_clientname': None,
     'redis_ssl_check_hostname': None,
     'redis_decode_responses': True,
+    'tiered_tiers': ['MemCache', 'RedisCache'],  # fastest first
+    'tiered_l1_ttl': 60,
+    'tiered_l1_max_entries': 10000,
+    'tiered_promote': True,
+    'codec': None,  # zlib, lzma or a (compress, decompress) tuple - see flex_cache.codec.get_codec
+    'codec_min_size': 1024,
 }
 
 
@@ -51,18 +62,36 @@ def init_cache_from_settings(settings):
                      'serializer': _load_func(merged['serializer']),
                      'deserializer': _load_func(merged['deserializer']),
                      }
-    if merged['type'] == 'MemCache':
+    if merged['serialization']:
+        common_kwargs.update(serialization_options(merged['serialization']))
+        if is_binary(common_kwargs['serializer']):
+            merged['redis_decode_responses'] = False  # serialized values are bytes
+    if merged['codec']:
+        common_kwargs.update(codec=merged['codec'], codec_min_size=merged['codec_min_size'])
+        merged['redis_decode_responses'] = False  # encoded values are bytes
+    if merged['type'] == 'TieredCache':
+        tiers = [_init_cache(cache_type, merged, common_kwargs) for cache_type in merged['tiered_tiers']]
+        return TieredCache(*tiers, l1_ttl=merged['tiered_l1_ttl'], promote=merged['tiered_promote'],
+                           **common_kwargs)
+    return _init_cache(merged['type'], merged, common_kwargs)
+
+
+def _init_cache(cache_type, merged, common_kwargs):
+    if cache_type == 'MemCache':
+        if merged['type'] == 'TieredCache':
+            return MemCache(max_entries=merged['tiered_l1_max_entries'], **common_kwargs)
         return MemCache(**common_kwargs)
-    elif merged['type'] == 'DiskCache':
+    elif cache_type == 'DiskCache':
         from diskcache import Cache as DCache
         dc = DCache(directory=merged['diskcache_directory'])
         return DiskCache(dc, **common_kwargs)
-    elif merged['type'] == 'RedisCache':
-        redis_kwargs = {k[6:]: v for k, v in common_kwargs.items() if k.startswith('redis')}
+    elif cache_type == 'RedisCache':
+        redis_kwargs = {k[6:]: v for k, v in merged.items() if k.startswith('redis_')}
+        redis_kwargs['client_name'] = redis_kwargs.pop('clientname')
         from redis import Redis
         client = Redis(**redis_kwargs)
         return RedisCache(client, **common_kwargs)
-    elif merged['type'] == 'NoCache':
+    elif cache_type == 'NoCache':
         return NoCache()
     else:
-        raise ValueError('Unsupported caching type: {}'.format(merged['type']))
+        raise ValueError('Unsupported caching type: {}'.format(cache_type))
@@ -0,0 +1,194 @@
+import asyncio
+import inspect
+from json import dumps, loads
+from time import time
+from uuid import uuid4
+from collections.abc import Mapping
+from .basecache import BaseCache, MISS, chunks, fn_args, tag_index_key
+from .executor import gather_calls
+from .rediscache import INVALIDATE_CHUNK_SIZE, RedisCacheDecorator, get_cache_lua_fn, get_drain_lua_fn, \
+    get_lease_lua_fn, get_release_lua_fn, get_tag_drain_lua_fn, get_tag_lua_fn, get_touch_lua_fn, get_ttl_lua_fn
+
+
+class AsyncRedisCache(BaseCache):
+    """
+    RedisCache for asyncio - it must be initiated with a redis.asyncio.Redis client, and can only decorate
+    coroutine functions. mget, get, set and invalidate are coroutines too.
+    """
+    def __init__(self, redis_client, prefix="rc", serializer=dumps, deserializer=loads, **options):
+        super().__init__(AsyncRedisCacheDecorator, redis_client, prefix, serializer, deserializer, **options)
+
+    async def mget(self, *fns_with_args, max_concurrency=0):
+        """
+        Returns the results of the functions (called with the args/kwargs), in the order of fns_with_args.
+        Missing results are computed concurrently - at most max_concurrency at a time, if > 0.
+        """
+        keys = self.mget_keys(*fns_with_args)
+        instances = [fn_and_args['fn'].instance for fn_and_args in fns_with_args]
+        if any(instance.touch_on_read for instance in instances):
+            pipeline = self._cache.pipeline(transaction=False)
+            for key, instance in zip(keys, instances):
+                if instance.touch_on_read:
+                    await get_touch_lua_fn(self._cache)(keys=[key, instance.keys_key],
+                                                        args=[instance.eviction_policy], client=pipeline)
+                else:
+                    pipeline.get(key)
+            results = await pipeline.execute()
+        else:
+            results = await self._cache.mget(*keys)
+        misses = [i for i, result in enumerate(results) if result is None]
+        computed = await gather_calls([fn_args(fns_with_args[i]) for i in misses], max_concurrency)
+
+        deserialized_results = [None if result is None else fn_and_args['fn'].instance._load(result)
+                                for result, fn_and_args in zip(results, fns_with_args)]
+        if misses:
+            pipeline = self._cache.pipeline()
+            ttls = []
+            for i, result in zip(misses, computed):
+                instance = fns_with_args[i]['fn'].instance
+                ttl = instance._result_ttl(result)
+                ttls.append(ttl)
+                await get_cache_lua_fn(self._cache)(keys=[keys[i], instance.keys_key],
+                                                    args=[instance.serializer(result),
+                                                          instance.ttl if ttl is None else ttl, instance.limit,
+                                                          instance.eviction_policy],
+                                                    client=pipeline)
+                deserialized_results[i] = result
+            await pipeline.execute()
+            for i, ttl in zip(misses, ttls):
+                instance = fns_with_args[i]['fn'].instance
+                if instance.tags:
+                    _, args, kwargs = fn_args(fns_with_args[i])
+                    await instance.atag_key(keys[i], instance._tags_of(args, kwargs), ttl)
+        return deserialized_results
+
+    async def get(self, key, namespace=None, default=None):
+        deco = self.cache(namespace=namespace)
+        serialized = await deco.acheck_cache(self._key(key, namespace))
+        if serialized is not MISS:
+            return deco.deserializer(serialized)
+        else:
+            return default
+
+    async def set(self, key, value, ttl=0, limit=0, namespace=None):
+        deco = self.cache(ttl, limit, namespace)
+        serialized = deco.serializer(value)
+        return await deco.acache_output(self._key(key, namespace), serialized)
+
+    async def invalidate(self, key, namespace=None):
+        deco = self.cache(namespace=namespace)
+        await deco.invalidate_key(self._key(key, namespace))
+
+    async def invalidate_tags(self, *tags):
+        drain = get_tag_drain_lua_fn(self._cache)
+        for tag in tags:
+            tag_key = tag_index_key(self.prefix, str(tag))
+            for keys_key in await self._cache.smembers(tag_key):
+                args = [INVALIDATE_CHUNK_SIZE, keys_key]
+                while await drain(keys=[tag_key], args=args) == INVALIDATE_CHUNK_SIZE:
+                    pass
+
+    async def get_many(self, keys, namespace=None, default=None, chunk_size=1000):
+        deco = self.cache(namespace=namespace)
+        values = []
+        for chunk in chunks(keys, chunk_size):
+            results = await self._cache.mget(*[self._key(key, namespace) for key in chunk])
+            values.extend(default if result is None else deco.deserializer(result) for result in results)
+        return values
+
+    async def set_many(self, items, ttl=0, limit=0, namespace=None, chunk_size=1000):
+        deco = self.cache(ttl, limit, namespace)
+        if isinstance(items, Mapping):
+            items = items.items()
+        for chunk in chunks(items, chunk_size):
+            pipeline = self._cache.pipeline()
+            for key, value in chunk:
+                await get_cache_lua_fn(self._cache)(keys=[self._key(key, namespace), deco.keys_key],
+                                                    args=[deco.serializer(value), deco.ttl, deco.limit,
+                                                          deco.eviction_policy],
+                                                    client=pipeline)
+            await pipeline.execute()
+
+    async def delete_many(self, keys, namespace=None, chunk_size=1000):
+        keys_key = self.cache(namespace=namespace).keys_key
+        for chunk in chunks(keys, chunk_size):
+            chunk = [self._key(key, namespace) for key in chunk]
+            pipeline = self._cache.pipeline()
+            pipeline.delete(*chunk)
+            pipeline.zrem(keys_key, *chunk)
+            await pipeline.execute()
+
+
+class AsyncRedisCacheDecorator(RedisCacheDecorator):
+    def __call__(self, fn):
+        if not inspect.iscoroutinefunction(fn):
+            raise ValueError('AsyncRedisCache can only decorate coroutine functions')
+        return super().__call__(fn)
+
+    async def acheck_cache(self, key):
+        if self.touch_on_read:
+            result = await get_touch_lua_fn(self.cache)(keys=[key, self.keys_key], args=[self.eviction_policy])
+        else:
+            result = await self.cache.get(key)
+        return MISS if result is None else result
+
+    async def acheck_cache_with_ttl(self, key):
+        policy = self.eviction_policy if self.touch_on_read else ''
+        result, ttl = await get_ttl_lua_fn(self.cache)(keys=[key, self.keys_key], args=[policy])
+        if result is None:
+            return MISS, None
+        return result, None if ttl < 0 else ttl / 1000
+
+    async def _aacquire_refresh(self, key):
+        token = uuid4().hex
+        if await self.cache.set(f'{key}:refresh', token, nx=True, px=int((self.ttl + self.stale_ttl) * 1000)):
+            return token
+        return None
+
+    async def _arelease_refresh(self, key, token):
+        await get_release_lua_fn(self.cache)(keys=[f'{key}:refresh'], args=[token])
+
+    async def acache_output(self, key, serialized, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        self._count_evictions(await get_cache_lua_fn(self.cache)(keys=[key, self.keys_key],
+                                                                 args=[serialized, ttl, self.limit,
+                                                                       self.eviction_policy]))
+
+    async def atag_key(self, key, tags, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        await get_tag_lua_fn(self.cache)(keys=[tag_index_key(self.prefix, tag) for tag in tags],
+                                         args=[key, ttl, self.keys_key])
+
+    async def _afill(self, key, args, kwargs):
+        if not self.lease_ttl:
+            return await self._acompute(key, args, kwargs)
+        lease_key = f'{key}:lease'
+        token = uuid4().hex
+        deadline = time() + self.lease_ttl
+        while time() < deadline:
+            result, acquired = await get_lease_lua_fn(self.cache)(keys=[key, lease_key],
+                                                                  args=[token, int(self.lease_ttl * 1000)])
+            if result is not None:
+                return self._load(result)
+            if acquired:
+                try:
+                    return await self._acompute(key, args, kwargs)
+                finally:
+                    await get_release_lua_fn(self.cache)(keys=[lease_key], args=[token])
+            await asyncio.sleep(self.lease_poll_interval)
+        # the lease holder is still computing, or has crashed - give up waiting
+        return await self._acompute(key, args, kwargs)
+
+    async def invalidate_key(self, key):
+        pipe = self.cache.pipeline()
+        pipe.delete(key)
+        pipe.zrem(self.keys_key, key)
+        await pipe.execute()
+
+    async def invalidate(self, *args, **kwargs):
+        await self.invalidate_key(self.get_key(args, kwargs))
+
+    async def invalidate_all(self, *args, **kwargs):
+        drain = get_drain_lua_fn(self.cache)
+        while await drain(keys=[self.keys_key], args=[INVALIDATE_CHUNK_SIZE]) == INVALIDATE_CHUNK_SIZE:
+            pass
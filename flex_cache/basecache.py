@@ -1,106 +1,867 @@
 from functools import wraps
+import asyncio
 import inspect
+from math import log
+from random import random
+from threading import Lock
+from time import perf_counter
 from json import dumps, loads
 from base64 import b64encode
+from hashlib import blake2b
+from collections import OrderedDict
+from collections.abc import Mapping
+from .codec import get_codec
+from .executor import default_refresh_executor, run_calls
+from .metrics import MetricsRegistry
+from .singleflight import SingleFlight, AsyncSingleFlight
+
+ERROR_KEY = '__flex_cache_error__'
+DELTA_KEY = '__flex_cache_delta__'
+
+
+class _Miss(object):
+    """
+    Returned by check_cache when a key is not cached - unlike None, it cannot be confused with a cached value
+    """
+    def __bool__(self):
+        return False
+
+    def __repr__(self):
+        return 'MISS'
+
+
+MISS = _Miss()
+_EMPTY = inspect.Parameter.empty
+
+
+def fn_args(fn_and_args):
+    """
+    Returns (fn, args, kwargs) of a dict of fn and optionally args and kwargs - as passed to mget
+    """
+    return fn_and_args['fn'], fn_and_args.get('args', []), fn_and_args.get('kwargs', {})
+
+
+def chunks(iterable, n):
+    """Yield successive n-sized chunks from iterator."""
+    _iterable = iter(iterable)
+    while True:
+        elements = []
+        for _ in range(n):
+            try:
+                elements.append(next(_iterable))
+            except StopIteration:
+                break
+
+        if not len(elements):
+            break
+
+        yield elements
+
+
+def tag_index_key(prefix, tag):
+    """
+    Returns the key of the index of the keys tagged with tag
+    """
+    return f'{prefix}:tag:{tag}'
+
+
+def jitter_ttl(ttl, jitter):
+    """
+    Shortens ttl at random, by up to the fraction jitter of it - to a fractional ttl, which all backends accept
+    """
+    return ttl - ttl * jitter * random()
+
+
+def hash_key(data):
+    """
+    Returns a fixed size (32 chars) hex digest of the serialized (str or bytes) data
+    """
+    if isinstance(data, str):
+        data = data.encode('utf-8')
+    return blake2b(data, digest_size=16).hexdigest()
+
+
+def _profiler(profiler):
+    # imported lazily - profiling needs contextvars, which caches without a profiler should not depend on
+    from .profiling import Profiler
+    return profiler if isinstance(profiler, Profiler) else Profiler(profiler)
+
+
+def payload_size(value):
+    return len(value) if isinstance(value, (str, bytes, bytearray)) else None
+
+
+def _result_size(args, result):
+    return payload_size(result)
+
+
+def _ttl_result_size(args, result):
+    return payload_size(result[0])
+
+
+def _arg_size(args, result):
+    return payload_size(args[0])
+
+
+def _output_size(args, result):
+    return payload_size(args[1])  # key, serialized, ttl
+
+
+def _mget_size(args, results):
+    return sum(payload_size(result) or 0 for result in results)
+
+
+def _mset_size(args, result):
+    return sum(payload_size(serialized) or 0 for _, _, serialized, _ in args[0])
+
+
+def _count_lookup(counters, result):
+    if result is MISS:
+        counters.misses += 1
+    else:
+        counters.hits += 1
+
+
+def _count_ttl_lookup(counters, result):
+    _count_lookup(counters, result[0])
+
+
+def _count_set(counters, result):
+    counters.sets += 1
 
 
 class BaseCache:
-    def __init__(self, decorator, cache, prefix="rc", serializer=dumps, deserializer=loads):
+    def __init__(self, decorator, cache, prefix="rc", serializer=dumps, deserializer=loads, **options):
+        """
+        Args:
+            **options: default keyword arguments for the decorators created by cache()
+        """
         self._decorator = decorator
         self._cache = cache
         self.prefix = prefix
         self.serializer = serializer
         self.deserializer = deserializer
+        self.options = options
+        self.metrics = MetricsRegistry()  # of the functions cached with metrics=True
+        profiler = options.get('profiler')
+        if profiler is not None:
+            # profiles the bulk paths too
+            profiler = options['profiler'] = _profiler(profiler)
+            for name in ('mget', 'get_many', 'set_many', 'delete_many'):
+                setattr(self, name, profiler.profiled(getattr(self, name), name))
+            self._delete_keys = profiler.phase(self._delete_keys, 'backend_write')
+            self._mget_serialized = profiler.phase(self._mget_serialized, 'backend_read', _mget_size)
+            self._mset_serialized = profiler.phase(self._mset_serialized, 'backend_write', _mset_size)
+            self._run_calls = profiler.phase(self._run_calls, 'compute_misses')
 
-    def cache(self, ttl=0, limit=0, namespace=None):
-        return self._decorator(self._cache, self.prefix, self.serializer, self.deserializer, ttl, limit, namespace)
+    def cache(self, ttl=0, limit=0, namespace=None, **kwargs):
+        options = dict(self.options, **kwargs)
+        if options.get('metrics') is True:
+            options['metrics'] = self.metrics
+        return self._decorator(self._cache, self.prefix, self.serializer, self.deserializer, ttl, limit, namespace,
+                               **options)
 
     def mget_keys(self, *fns_with_args):
-        keys = []
-        for fn_and_args in fns_with_args:
-            fn = fn_and_args['fn']
-            args = fn_and_args['args'] if 'args' in fn_and_args else []
-            kwargs = fn_and_args['kwargs'] if 'kwargs' in fn_and_args else {}
-            keys.append(fn.instance.get_key(args=args, kwargs=kwargs))
-        return keys
-
-    def mget(self, *fns_with_args):
-        raise NotImplementedError('Must be implemented in derived classes')
+        return [fn.instance.get_key(args=args, kwargs=kwargs) for fn, args, kwargs in map(fn_args, fns_with_args)]
+
+    def mget(self, *fns_with_args, executor=None, max_concurrency=0):
+        """
+        Returns the results of the functions (called with the args/kwargs), in the order of fns_with_args.
+        Cached results are read in bulk - missing results are computed, and then cached in bulk.
+        Args:
+            *fns_with_args: dicts of fn (a cached function) and optionally args and kwargs
+            executor: computes the missing results concurrently - a ThreadPoolExecutor, a ProcessPoolExecutor or
+                an asyncio event loop (see executor.run_calls). By default they are computed sequentially
+            max_concurrency: max number of missing results computed at a time - 0 means no limit
+        """
+        keys = self.mget_keys(*fns_with_args)
+        instances = [fn_and_args['fn'].instance for fn_and_args in fns_with_args]
+        results = self._mget_serialized(keys, instances)
+        misses = []
+        for i, result in enumerate(results):
+            if result is MISS:
+                misses.append(i)
+            else:
+                results[i] = instances[i]._load(result)
+        calls = [fn_args(fns_with_args[i]) for i in misses]
+        computed = self._run_calls(calls, executor, max_concurrency)
+        outputs = []
+        for i, result in zip(misses, computed):
+            instance = instances[i]
+            serialized = instance.serializer(result)
+            outputs.append((instance, keys[i], serialized, instance._result_ttl(result)))
+            results[i] = instance._result(result, serialized)
+        if outputs:
+            self._mset_serialized(outputs)
+        for (instance, key, _, ttl), (_, args, kwargs) in zip(outputs, calls):
+            if instance.tags:
+                instance.tag_key(key, instance._tags_of(args, kwargs), ttl)
+        return results
+
+    def _run_calls(self, calls, executor, max_concurrency):
+        return run_calls(calls, executor, max_concurrency)
+
+    def _mget_serialized(self, keys, instances):
+        """
+        Returns the serialized values (or MISS) of the keys - backends override this to read them in bulk
+        """
+        return [instance.check_cache(key) for key, instance in zip(keys, instances)]
+
+    def _mset_serialized(self, outputs):
+        """
+        Caches (instance, key, serialized, ttl) tuples - backends override this to write them in bulk
+        """
+        for instance, key, serialized, ttl in outputs:
+            instance.cache_output(key, serialized, ttl)
+
+    def _delete_keys(self, deco, keys):
+        """
+        Invalidates the keys of deco - backends override this to delete them in bulk
+        """
+        for key in keys:
+            deco.invalidate_key(key)
 
     def _key(self, key, namespace=None):
-        if not isinstance(key, str):
+        if self.options.get('key_strategy') == 'hash':
+            key = hash_key(key)
+        elif not isinstance(key, str):
             key = str(b64encode(key), 'utf-8')
         if namespace:
             return f'{self.prefix}:{namespace}:{key}'
         else:
             return f'{self.prefix}:{key}'
 
-    def get(self, key, namespace=None):
-        serialized = self.cache(namespace=namespace).check_cache(self._key(key, namespace))
-        if serialized:
-            return self.deserializer(serialized)
+    def get(self, key, namespace=None, default=None):
+        deco = self.cache(namespace=namespace)
+        serialized = deco.check_cache(self._key(key, namespace))
+        if serialized is not MISS:
+            return deco.deserializer(serialized)
         else:
-            return None
+            return default
 
     def set(self, key, value, ttl=0, limit=0, namespace=None):
-        serialized = self.serializer(value)
         deco = self.cache(ttl, limit, namespace)
-        deco.keys_key = self._key('keys', namespace=namespace)
+        serialized = deco.serializer(value)
         return deco.cache_output(self._key(key, namespace), serialized)
 
     def invalidate(self, key, namespace=None):
         deco = self.cache(namespace=namespace)
-        deco.keys_key = self._key('keys', namespace=namespace)
         deco.invalidate_key(self._key(key, namespace))
 
+    def invalidate_tags(self, *tags):
+        """
+        Invalidates the values cached with any of the tags (see the tags argument of cache()) - across all functions
+        and namespaces of the cache. The cost is proportional to the number of tagged keys, not the size of the cache
+        """
+        self._invalidate_tags([str(tag) for tag in tags])
+
+    def _invalidate_tags(self, tags):
+        raise NotImplementedError('Must be implemented in derived classes')
+
+    def get_many(self, keys, namespace=None, default=None, chunk_size=1000):
+        """
+        Returns the values of keys (an iterable) in order - default for keys not cached.
+        The keys are read in bulk, chunk_size keys at a time.
+        """
+        deco = self.cache(namespace=namespace)
+        values = []
+        for chunk in chunks(keys, chunk_size):
+            serialized = self._mget_serialized([self._key(key, namespace) for key in chunk], [deco] * len(chunk))
+            values.extend(default if s is MISS else deco.deserializer(s) for s in serialized)
+        return values
+
+    def set_many(self, items, ttl=0, limit=0, namespace=None, chunk_size=1000):
+        """
+        Sets the (key, value) items of items (a dict or an iterable of pairs).
+        The items are written in bulk, chunk_size items at a time - so memory stays bounded for large iterables.
+        """
+        deco = self.cache(ttl, limit, namespace)
+        if isinstance(items, Mapping):
+            items = items.items()
+        for chunk in chunks(items, chunk_size):
+            self._mset_serialized([(deco, self._key(key, namespace), deco.serializer(value), None)
+                                   for key, value in chunk])
+
+    def delete_many(self, keys, namespace=None, chunk_size=1000):
+        """
+        Invalidates keys (an iterable) in bulk, chunk_size keys at a time
+        """
+        deco = self.cache(namespace=namespace)
+        for chunk in chunks(keys, chunk_size):
+            self._delete_keys(deco, [self._key(key, namespace) for key in chunk])
+
+
+class BindingPlan(object):
+    """
+    Maps the arguments of a call to a canonical (args, kwargs) pair, so f(1, 2), f(1, b=2) and f(a=1) (with b=2 as
+    default) produce the same key. The plan is derived once from the signature of the function, so binding a call
+    is a couple of tuple/dict operations, rather than inspect.signature(...).bind().
+    The canonical args are the values of all named parameters (in order, with defaults applied) followed by any
+    extra positional (*args) values - the canonical kwargs are the extra keyword (**kwargs) values, sorted by name.
+    """
+    def __init__(self, fn):
+        positional = []
+        keyword_only = []
+        for param in inspect.signature(fn).parameters.values():
+            if param.kind in (param.POSITIONAL_ONLY, param.POSITIONAL_OR_KEYWORD):
+                positional.append((param.name, param.default))
+            elif param.kind == param.KEYWORD_ONLY:
+                keyword_only.append((param.name, param.default))
+        self.npos = len(positional)
+        self.keyword_only = bool(keyword_only)
+        self.named = tuple(positional + keyword_only)
+
+    def bind(self, args, kwargs):
+        npos = self.npos
+        if not kwargs and not self.keyword_only and len(args) >= npos:
+            return args, kwargs  # already canonical
+        kwargs = kwargs.copy()
+        values = list(args[:npos])
+        for name, default in self.named[len(values):]:
+            value = kwargs.pop(name, default)
+            if value is _EMPTY:
+                raise TypeError(f'missing required argument: \'{name}\'')
+            values.append(value)
+        if len(args) > npos:
+            values.extend(args[npos:])
+        if kwargs:
+            kwargs = dict(sorted(kwargs.items()))
+        return tuple(values), kwargs
+
 
 class BaseCacheDecorator:
-    def __init__(self, cache, prefix='rc', serializer=dumps, deserializer=loads, ttl=0, limit=0, namespace=None):
+    def __init__(self, cache, prefix='rc', serializer=dumps, deserializer=loads, ttl=0, limit=0, namespace=None,
+                 single_flight=False, single_flight_timeout=10, negative_ttl=0, negative_exceptions=(),
+                 key_strategy='full', key_debug=False, key_debug_size=1024, normalize_args=False, tags=None,
+                 codec=None, codec_min_size=1024, stale_ttl=0, refresh_executor=None, early_recompute=0,
+                 ttl_jitter=0, refresh_ahead=None, metrics=False,
+                 profiler=None, key_serializer=None):
+        """
+        Args:
+            single_flight: if True, concurrent callers missing on the same key wait for a single computation
+            single_flight_timeout: seconds a waiting caller will wait, before computing the value itself
+            negative_ttl: if > 0, None results (and negative_exceptions) are cached for negative_ttl seconds
+            negative_exceptions: tuple of exception classes, which are cached and re-raised on hits
+            key_strategy: 'full' keys contain the serialized arguments, 'hash' keys contain a digest of them
+            key_debug: if True (and key_strategy is 'hash'), the serialized arguments of the last key_debug_size
+                       keys are kept in key_args - mapping key: serialized arguments
+            normalize_args: if True, arguments are bound to the signature of the function (see BindingPlan) before
+                            building the key, so positional/keyword/default variants of a call share the same key
+            tags: tags of the cached values, for BaseCache.invalidate_tags - a tag, a list of tags or a callable
+                  returning the tags of a call (called with the arguments of the call)
+            codec: compresses serialized values (of at least codec_min_size bytes) - 'zlib', 'lzma', a
+                   (compress, decompress) tuple or an object with compress/decompress functions (see codec.get_codec).
+                   Encoded values are bytes, so redis clients must not decode responses
+            stale_ttl: if > 0, values are kept for stale_ttl seconds after their ttl - and served (stale) meanwhile,
+                       while a single background refresh recomputes them
+            refresh_executor: the concurrent.futures.Executor running the refreshes of stale values - by default a
+                              shared thread pool (see executor.default_refresh_executor)
+            early_recompute: if > 0 (or True), hits refresh values in the background before their ttl, at random -
+                             more likely the closer the value is to its ttl and the longer it took to compute (XFetch).
+                             Higher values (the beta of XFetch, 1 for True) refresh earlier
+            ttl_jitter: shortens the ttl of each cached value at random, by up to this fraction of it (eg. 0.1), so
+                        values cached together do not expire together
+            refresh_ahead: a refresh.RefreshAheadScheduler - which recomputes the hot keys of the function shortly
+                           before they expire
+            metrics: if True, hits, misses, sets, evictions and errors are counted - and the latencies of backend reads,
+                     writes and computations recorded - per namespace, in the metrics.MetricsRegistry of the cache
+            profiler: a profiling.Profiler (or a callback, to profile every call) - which reports the duration (and
+                      payload size) of each phase of sampled calls: key, filter_args, backend_read, deserialize,
+                      compute, serialize and backend_write
+            key_serializer: serializes the arguments of calls into keys - serializer by default. Must be canonical
+                            (equal arguments serialize the same), see serializers.key_dumps
+        """
         self.cache = cache
         self.prefix = prefix
         self.serializer = serializer
         self.deserializer = deserializer
+        self.key_serializer = key_serializer or serializer
         self.ttl = ttl
         self.limit = limit
         self.namespace = namespace
-        self.keys_key = None
+        # the index of the keys of the namespace - so invalidate_all works on namespaces filled through set/set_many
+        self.keys_key = f'{prefix}:{namespace}:keys' if namespace else f'{prefix}:keys'
+        self.single_flight = SingleFlight(single_flight_timeout) if single_flight else None
+        self.negative_ttl = negative_ttl
+        self.negative_exceptions = tuple(negative_exceptions)
+        self._negative_classes = {f'{c.__module__}.{c.__qualname__}': c for c in self.negative_exceptions}
+        if key_strategy not in ('full', 'hash'):
+            raise ValueError('Unsupported key strategy: {}'.format(key_strategy))
+        self.key_strategy = key_strategy
+        self.key_args = OrderedDict() if key_debug else None
+        self._key_args_lock = Lock()
+        self.key_debug_size = key_debug_size
+        self.normalize_args = normalize_args
+        self.binding_plan = None
+        self.tags = (tags,) if isinstance(tags, str) else tags
+        if (stale_ttl or early_recompute) and not ttl:
+            raise ValueError('stale_ttl and early_recompute require a ttl')
+        self.stale_ttl = stale_ttl
+        self.early_recompute = float(early_recompute)
+        self.ttl_jitter = ttl_jitter
+        self.refresh_ahead = refresh_ahead
+        self.metrics_registry = MetricsRegistry() if metrics is True else metrics or None
+        self.metrics = None
+        self.profiler = None if profiler is None else _profiler(profiler)
+        self.refresh_executor = refresh_executor
+        self._refreshing = set()  # keys being refreshed
+        self._refreshing_lock = Lock()
+        self._refresh_tasks = set()
+        self.codec = get_codec(codec, codec_min_size) if codec else None
+        if self.codec:
+            # keys are serialized by key_serializer - so they are never encoded
+            self.serializer = self.codec.serializer(serializer)
+            self.deserializer = self.codec.deserializer(deserializer)
 
     def get_key(self, args, kwargs):
+        if self.binding_plan is not None:
+            args, kwargs = self.binding_plan.bind(args, kwargs)
         args = self.filter_pos_args(args)
-        serialized_data = self.serializer([args, kwargs])
+        serialized_data = self.key_serializer([args, kwargs])
 
+        if self.key_strategy == 'hash':
+            key = f'{self.prefix}:{self.namespace}:{hash_key(serialized_data)}'
+            if self.key_args is not None:
+                self._remember_key_args(key, serialized_data)
+            return key
         if not isinstance(serialized_data, str):
             serialized_data = str(b64encode(serialized_data), 'utf-8')
         return f'{self.prefix}:{self.namespace}:{serialized_data}'
 
-    def __call__(self, fn):
+    def _remember_key_args(self, key, serialized_data):
+        with self._key_args_lock:
+            self.key_args[key] = serialized_data
+            self.key_args.move_to_end(key)
+            while len(self.key_args) > self.key_debug_size:
+                self.key_args.popitem(last=False)
+
+    def _bind_function(self, fn):
         self.namespace = self.namespace if self.namespace else f'{fn.__module__}.{fn.__name__}'
         self.keys_key = f'{self.prefix}:{self.namespace}:keys'
         self.original_fn = fn
         self.original_argspec = inspect.getfullargspec(fn)
+        if self.normalize_args:
+            self.binding_plan = BindingPlan(fn)
+
+    def __call__(self, fn):
+        self._bind_function(fn)
+        if self.metrics_registry is not None:
+            self._instrument()
+        if self.profiler is not None:
+            self._profile_phases()
+        if inspect.iscoroutinefunction(fn):
+            if self.refresh_ahead is not None:
+                raise ValueError('refresh_ahead does not support coroutine functions')
+            return self._decorate_coroutine_function(fn)
 
         @wraps(fn)
         def inner(*args, **kwargs):
             nonlocal self
             key = self.get_key(args, kwargs)
-            result = self.check_cache(key)
-            if not result:
-                result = fn(*args, **kwargs)
-                result_serialized = self.serializer(result)
-                self.cache_output(key, result_serialized)
+            if self.stale_ttl or self.early_recompute:
+                result = self._check_cache_or_refresh(key, args, kwargs)
+                if result is not MISS:
+                    if self.refresh_ahead is not None:
+                        self.refresh_ahead.hit(self, key)
+                    return result
+            else:
+                result = self.check_cache(key)
+            if result is MISS:
+                if self.single_flight:
+                    return self.single_flight.do(key, self._recheck_and_fill, key, args, kwargs)
+                return self._fill(key, args, kwargs)
+            else:
+                if self.refresh_ahead is not None:
+                    self.refresh_ahead.hit(self, key)
+                return self._load(result)
+
+        if self.profiler is not None:
+            inner = self.profiler.profiled(inner, self.namespace)
+        inner.invalidate = self.invalidate
+        inner.invalidate_all = self.invalidate_all
+        inner.cache_info = self.cache_info
+        inner.instance = self
+        return inner
+
+    def _instrument(self):
+        """
+        Counts & times the backend calls and computations of the function, by wrapping them - so functions without
+        metrics do not pay for them
+        """
+        metrics = self.metrics = self.metrics_registry.namespace(self.namespace)
+        self.check_cache = metrics.timed(self.check_cache, 'read', _count_lookup)
+        self.check_cache_with_ttl = metrics.timed(self.check_cache_with_ttl, 'read', _count_ttl_lookup)
+        self.cache_output = metrics.timed(self.cache_output, 'write', _count_set)
+        # the default async versions call the (already wrapped) blocking ones
+        if self._overrides('acheck_cache'):
+            self.acheck_cache = metrics.atimed(self.acheck_cache, 'read', _count_lookup)
+        if self._overrides('acheck_cache_with_ttl'):
+            self.acheck_cache_with_ttl = metrics.atimed(self.acheck_cache_with_ttl, 'read', _count_ttl_lookup)
+        if self._overrides('acache_output'):
+            self.acache_output = metrics.atimed(self.acache_output, 'write', _count_set)
+        timed = metrics.atimed if inspect.iscoroutinefunction(self.original_fn) else metrics.timed
+        self.original_fn = timed(self.original_fn, 'compute')
+
+    def _profile_phases(self):
+        """
+        Wraps the phases of a call, so the profiler can time them - functions without a profiler are not wrapped
+        """
+        phase = self.profiler.phase
+        self.get_key = phase(self.get_key, 'key', _result_size)
+        self.filter_pos_args = phase(self.filter_pos_args, 'filter_args')
+        self.check_cache = phase(self.check_cache, 'backend_read', _result_size)
+        self.check_cache_with_ttl = phase(self.check_cache_with_ttl, 'backend_read', _ttl_result_size)
+        self.cache_output = phase(self.cache_output, 'backend_write', _output_size)
+        self.deserializer = phase(self.deserializer, 'deserialize', _arg_size)
+        self.serializer = phase(self.serializer, 'serialize', _result_size)
+        if self._overrides('acheck_cache'):
+            self.acheck_cache = phase(self.acheck_cache, 'backend_read', _result_size)
+        if self._overrides('acheck_cache_with_ttl'):
+            self.acheck_cache_with_ttl = phase(self.acheck_cache_with_ttl, 'backend_read', _ttl_result_size)
+        if self._overrides('acache_output'):
+            self.acache_output = phase(self.acache_output, 'backend_write', _output_size)
+        self.original_fn = phase(self.original_fn, 'compute')
+
+    def _count_evictions(self, evicted):
+        """
+        Counts the evictions caused by a set - backends call it, as cache_output does not return them
+        """
+        if evicted and self.metrics is not None:
+            self.metrics.counters().evictions += evicted
+
+    def _overrides(self, name):
+        """
+        Returns True if the class of the decorator overrides BaseCacheDecorator.name
+        """
+        return getattr(type(self), name) is not getattr(BaseCacheDecorator, name)
+
+    def cache_info(self):
+        """
+        Returns the metrics.CacheInfo of the namespace - hits, misses, sets, evictions, errors and the latencies of
+        backend reads, writes and computations
+        """
+        if self.metrics is None:
+            raise ValueError('Metrics are not enabled - use metrics=True')
+        return self.metrics.snapshot()
+
+    def _decorate_coroutine_function(self, fn):
+        if self.single_flight:
+            self.single_flight = AsyncSingleFlight(self.single_flight.timeout)
+
+        @wraps(fn)
+        async def inner(*args, **kwargs):
+            key = self.get_key(args, kwargs)
+            if self.stale_ttl or self.early_recompute:
+                result = await self._acheck_cache_or_refresh(key, args, kwargs)
+                if result is not MISS:
+                    return result
             else:
-                result = self.deserializer(result)
-            return result
+                result = await self.acheck_cache(key)
+            if result is MISS:
+                if self.single_flight:
+                    return await self.single_flight.do(key, self._arecheck_and_fill, key, args, kwargs)
+                return await self._afill(key, args, kwargs)
+            else:
+                return self._load(result)
 
+        if self.profiler is not None:
+            inner = self.profiler.profiled(inner, self.namespace)
         inner.invalidate = self.invalidate
         inner.invalidate_all = self.invalidate_all
+        inner.cache_info = self.cache_info
         inner.instance = self
         return inner
 
+    async def _acompute(self, key, args, kwargs):
+        start = perf_counter()
+        try:
+            result = await self.original_fn(*args, **kwargs)
+        except self.negative_exceptions as e:
+            await self._acache_error(key, e)
+            if self.tags:
+                await self.atag_key(key, self._tags_of(args, kwargs), self._error_ttl())
+            raise
+        result_serialized = self._serialize_result(result, perf_counter() - start)
+        ttl = self._result_ttl(result)
+        await self.acache_output(key, result_serialized, ttl)
+        if self.tags:
+            await self.atag_key(key, self._tags_of(args, kwargs), ttl)
+        return self._result(result, result_serialized)
+
+    async def _acache_error(self, key, error):
+        serialized = self._serialize_error(error)
+        if serialized is not None:
+            await self.acache_output(key, serialized, self._error_ttl())
+
+    async def _afill(self, key, args, kwargs):
+        return await self._acompute(key, args, kwargs)
+
+    async def _arecheck_and_fill(self, key, args, kwargs):
+        # bypasses the metrics wrappers, as _recheck_and_fill does
+        if self._overrides('acheck_cache'):
+            result = await type(self).acheck_cache(self, key)
+        else:
+            result = type(self).check_cache(self, key)
+        if result is not MISS:
+            return self._load(result)
+        return await self._afill(key, args, kwargs)
+
+    async def _acheck_cache_or_refresh(self, key, args, kwargs):
+        serialized, remaining = await self.acheck_cache_with_ttl(key)
+        if serialized is MISS:
+            return MISS
+        result, delta = self._load_entry(serialized)
+        if remaining is not None and self._should_refresh(remaining, delta):
+            with self._refreshing_lock:
+                refreshing = key in self._refreshing
+                self._refreshing.add(key)
+            if not refreshing:
+                task = asyncio.ensure_future(self._arun_refresh(key, args, kwargs))
+                self._refresh_tasks.add(task)  # tasks are only weakly referenced by the loop
+                task.add_done_callback(self._refresh_tasks.discard)
+        return result
+
+    async def _arun_refresh(self, key, args, kwargs):
+        try:
+            token = await self._aacquire_refresh(key)
+            if token:
+                try:
+                    await self._acompute(key, args, kwargs)
+                finally:
+                    await self._arelease_refresh(key, token)
+        except Exception:
+            pass  # the stale value is served until it expires - or a later refresh succeeds
+        finally:
+            with self._refreshing_lock:
+                self._refreshing.discard(key)
+
+    async def _aacquire_refresh(self, key):
+        return self._acquire_refresh(key)
+
+    async def _arelease_refresh(self, key, token):
+        self._release_refresh(key, token)
+
+    async def acheck_cache_with_ttl(self, key):
+        return self.check_cache_with_ttl(key)
+
+    async def acheck_cache(self, key):
+        """
+        Async version of check_cache - uses the blocking one by default, as in-process backends do not block for long
+        """
+        return self.check_cache(key)
+
+    async def acache_output(self, key, serialized, ttl=None):
+        return self.cache_output(key, serialized, ttl)
+
+    async def atag_key(self, key, tags, ttl=None):
+        self.tag_key(key, tags, ttl)
+
+    def _compute(self, key, args, kwargs):
+        start = perf_counter()
+        try:
+            result = self.original_fn(*args, **kwargs)
+        except self.negative_exceptions as e:
+            self._cache_error(key, e)
+            if self.tags:
+                self.tag_key(key, self._tags_of(args, kwargs), self._error_ttl())
+            raise
+        result_serialized = self._serialize_result(result, perf_counter() - start)
+        ttl = self._result_ttl(result)
+        self.cache_output(key, result_serialized, ttl)
+        if self.tags:
+            self.tag_key(key, self._tags_of(args, kwargs), ttl)
+        if self.refresh_ahead is not None and (ttl or self.ttl):
+            self.refresh_ahead.computed(self, key, args, kwargs, (ttl or self.ttl) - self.stale_ttl)
+        return self._result(result, result_serialized)
+
+    def _tags_of(self, args, kwargs):
+        """
+        Returns the tags of a call
+        """
+        tags = self.tags(*args, **kwargs) if callable(self.tags) else self.tags
+        if isinstance(tags, str):
+            tags = (tags,)
+        return [str(tag) for tag in tags]
+
+    def _result(self, result, serialized):
+        """
+        Returns the result of a computation to the caller
+        """
+        return result
+
+    def _serialize_result(self, result, delta):
+        if self.early_recompute:
+            # the compute time is stored next to the value, for deciding when to recompute it
+            return self.serializer({DELTA_KEY: delta, 'value': result})
+        return self.serializer(result)
+
+    def _result_ttl(self, result):
+        """
+        Returns the ttl for caching result - None means the ttl of the decorator
+        """
+        if result is None and self.negative_ttl:
+            ttl = self.negative_ttl
+        elif self.ttl and (self.stale_ttl or self.ttl_jitter):
+            ttl = self.ttl
+        else:
+            return None
+        if self.ttl_jitter:
+            ttl = jitter_ttl(ttl, self.ttl_jitter)
+        # values are kept - and served stale - for stale_ttl seconds past their ttl
+        return ttl + self.stale_ttl
+
+    def _check_cache_or_refresh(self, key, args, kwargs):
+        """
+        check_cache for stale_ttl & early_recompute - returns the deserialized value (or MISS), after scheduling a
+        background refresh if the value is stale (past its ttl) or XFetch decides to recompute it early
+        """
+        serialized, remaining = self.check_cache_with_ttl(key)
+        if serialized is MISS:
+            return MISS
+        result, delta = self._load_entry(serialized)
+        if remaining is not None and self._should_refresh(remaining, delta):
+            self._refresh(key, args, kwargs)
+        return result
+
+    def _should_refresh(self, remaining, delta):
+        """
+        Returns True if a value with remaining seconds to live, which took delta seconds to compute, should be refreshed
+        """
+        fresh = remaining - self.stale_ttl
+        if fresh <= 0:
+            return True
+        # XFetch: recompute early with a probability growing as the value nears its ttl, scaled by its compute time
+        return self.early_recompute and delta > 0 and -delta * self.early_recompute * log(1 - random()) >= fresh
+
+    def _refresh(self, key, args, kwargs):
+        """
+        Recomputes a stale value in the background - unless this process is already refreshing it
+        """
+        with self._refreshing_lock:
+            if key in self._refreshing:
+                return
+            self._refreshing.add(key)
+        try:
+            (self.refresh_executor or default_refresh_executor()).submit(self._run_refresh, key, args, kwargs)
+        except BaseException:
+            with self._refreshing_lock:
+                self._refreshing.discard(key)
+            raise
+
+    def _run_refresh(self, key, args, kwargs):
+        try:
+            token = self._acquire_refresh(key)
+            if token:
+                try:
+                    self._compute(key, args, kwargs)
+                finally:
+                    self._release_refresh(key, token)
+        except Exception:
+            pass  # the stale value is served until it expires - or a later refresh succeeds
+        finally:
+            with self._refreshing_lock:
+                self._refreshing.discard(key)
+
+    def _acquire_refresh(self, key):
+        """
+        Returns a token, if this process may refresh the stale value of key - derived classes may override this to
+        coordinate refreshes across processes
+        """
+        return True
+
+    def _release_refresh(self, key, token):
+        pass
+
+    def _cache_error(self, key, error):
+        serialized = self._serialize_error(error)
+        if serialized is not None:
+            self.cache_output(key, serialized, self._error_ttl())
+
+    def _error_ttl(self):
+        """
+        Returns the ttl for caching an exception - None means the ttl of the decorator
+        """
+        if self.stale_ttl:
+            return (self.negative_ttl or self.ttl) + self.stale_ttl
+        return self.negative_ttl or None
+
+    def _serialize_error(self, error):
+        cls = type(error)
+        try:
+            return self.serializer({ERROR_KEY: f'{cls.__module__}.{cls.__qualname__}', 'args': list(error.args)})
+        except Exception:
+            return None  # the exception arguments are not serializable - so it cannot be cached
+
+    def _load(self, serialized):
+        """
+        Deserializes a cached value - raising it, if it is a cached exception
+        """
+        if self.early_recompute:
+            return self._load_entry(serialized)[0]
+        result = self.deserializer(serialized)
+        if self.negative_exceptions and isinstance(result, Mapping) and ERROR_KEY in result:
+            self._raise_error(result)
+        return result
+
+    def _load_entry(self, serialized):
+        """
+        Deserializes a cached value, as (value, seconds it took to compute - 0 if not recorded)
+        """
+        result = self.deserializer(serialized)
+        if isinstance(result, Mapping):
+            if DELTA_KEY in result:
+                return result['value'], result[DELTA_KEY]
+            if self.negative_exceptions and ERROR_KEY in result:
+                self._raise_error(result)
+        return result, 0
+
+    def _raise_error(self, result):
+        cls = self._negative_classes.get(result[ERROR_KEY], Exception)
+        error = cls.__new__(cls)
+        error.args = tuple(result['args'])
+        raise error
+
+    def _fill(self, key, args, kwargs):
+        """
+        Handles a cache miss - derived classes may override this to coordinate the computation across processes
+        """
+        return self._compute(key, args, kwargs)
+
+    def _recheck_and_fill(self, key, args, kwargs):
+        """
+        Executed by the single flight leader - a previous leader may have filled the cache
+        between our miss and us acquiring the lead, so check again before computing.
+        The recheck bypasses the metrics wrapper of check_cache - the miss was already counted
+        """
+        result = type(self).check_cache(self, key)
+        if result is not MISS:
+            return self._load(result)
+        return self._fill(key, args, kwargs)
+
     def check_cache(self, key):
+        """
+        Returns the serialized value cached under key - or MISS
+        """
+        raise NotImplementedError('Must be implemented in derived classes')
+
+    def check_cache_with_ttl(self, key):
+        """
+        Returns the serialized value cached under key (or MISS) and its remaining ttl in seconds (None if it does not
+        expire) - as (value, ttl)
+        """
+        raise NotImplementedError('Must be implemented in derived classes')
+
+    def cache_output(self, key, serialized, ttl=None):
+        """
+        Caches the serialized value under key, for ttl seconds (or the ttl of the decorator, if None).
+        Backends enforcing limits count the keys evicted to make room with _count_evictions
+        """
         raise NotImplementedError('Must be implemented in derived classes')
 
-    def cache_output(self, key, serialized):
+    def tag_key(self, key, tags, ttl=None):
+        """
+        Adds key to the indexes of tags - which must outlive the key, ie. ttl seconds (or the ttl of the decorator)
+        """
         raise NotImplementedError('Must be implemented in derived classes')
 
     def invalidate_key(self, key):
@@ -0,0 +1,94 @@
+import lzma
+import zlib
+
+# Header of stored values: MAGIC, then a byte telling how the value was encoded. Values stored without a codec never
+# start with MAGIC - 0xFF never occurs in UTF-8, pickles start with 0x80 or an ASCII opcode, and msgpack values
+# starting with 0xF8-0xFF are single bytes (-8..-1) - so they can be told apart from encoded ones.
+# The low bit of the kind byte tells whether the serialized value was text (str), which is restored as such.
+MAGIC = b'\xff\xfc'
+RAW = 0x00
+ZLIB = 0x02
+LZMA = 0x04
+CUSTOM = 0x06
+TEXT = 0x01
+
+DECOMPRESSORS = {
+    ZLIB: zlib.decompress,
+    LZMA: lzma.decompress,
+}
+
+
+class Codec(object):
+    """
+    Compresses serialized values of at least min_size bytes - if it makes them smaller.
+    Encoded values are always bytes: a header (MAGIC and a kind byte - see RAW..CUSTOM) followed by the (compressed)
+    serialized value.
+    Values without a header (stored before the codec was enabled) are decoded as is.
+    """
+    def __init__(self, compress, decompress, header=CUSTOM, min_size=1024):
+        self.compress = compress
+        self.decompress = decompress
+        self.header = header
+        self.min_size = min_size
+
+    def encode(self, serialized):
+        text = isinstance(serialized, str)
+        data = serialized.encode('utf-8') if text else serialized
+        if len(data) >= self.min_size:
+            compressed = self.compress(data)
+            if len(compressed) < len(data):
+                return MAGIC + bytes((self.header | text,)) + compressed
+        return MAGIC + bytes((RAW | text,)) + data
+
+    def decode(self, stored):
+        if isinstance(stored, str) or len(stored) <= len(MAGIC) or stored[:len(MAGIC)] != MAGIC:
+            return stored
+        kind, text = stored[len(MAGIC)] & ~TEXT, stored[len(MAGIC)] & TEXT
+        data = memoryview(stored)[len(MAGIC) + 1:]
+        if kind == RAW:
+            data = bytes(data)
+        elif kind in DECOMPRESSORS:
+            data = DECOMPRESSORS[kind](data)
+        elif self.header == CUSTOM:
+            data = self.decompress(bytes(data))
+        else:
+            raise ValueError('Value was encoded by a custom codec - it cannot be decoded by a {} codec'.format(
+                'zlib' if self.header == ZLIB else 'lzma'))
+        return data.decode('utf-8') if text else data
+
+    def serializer(self, serializer):
+        """
+        Returns serializer followed by encode
+        """
+        def serialize(value):
+            return self.encode(serializer(value))
+        return serialize
+
+    def deserializer(self, deserializer):
+        """
+        Returns decode followed by deserializer
+        """
+        def deserialize(stored):
+            return deserializer(self.decode(stored))
+        return deserialize
+
+
+def get_codec(codec, min_size=1024):
+    """
+    Returns a Codec
+    Args:
+        codec: 'zlib', 'lzma', a (compress, decompress) tuple of callables, or an object with compress/decompress
+               functions (eg. a module) - or a Codec
+        min_size: values smaller than this (in bytes, serialized) are not compressed
+    """
+    if isinstance(codec, Codec):
+        return codec
+    if codec == 'zlib':
+        return Codec(zlib.compress, zlib.decompress, ZLIB, min_size)
+    if codec == 'lzma':
+        return Codec(lzma.compress, lzma.decompress, LZMA, min_size)
+    if isinstance(codec, tuple):
+        return Codec(codec[0], codec[1], CUSTOM, min_size)
+    if callable(getattr(codec, 'compress', None)) and callable(getattr(codec, 'decompress', None)):
+        return Codec(codec.compress, codec.decompress, CUSTOM, min_size)
+    raise ValueError('Unsupported codec: {}'.format(codec))
@@ -1,24 +1,179 @@
+from contextlib import contextmanager, ExitStack
 from json import dumps, loads
+from os import path
 from time import time
+from urllib.parse import quote
 from diskcache import Cache as DCache
+from diskcache.core import EVICTION_POLICY
+from .basecache import MISS, tag_index_key
 from .memcache import MemCache, MemCacheDecorator
 
+EVICTION_POLICIES = {
+    'fifo': 'least-recently-stored',
+    'lru': 'least-recently-used',
+    'lfu': 'least-frequently-used',
+}
+
+
+def get_namespace_cache(dcache, namespace, create=False, **settings):
+    """
+    Returns the diskcache.Cache backing a namespace with limits - or None if the namespace has no limits.
+    The namespace caches are stored in sub-directories of dcache, so the eviction policies and size limits
+    of diskcache apply to each namespace individually.
+    Args:
+        dcache: the parent diskcache.Cache
+        namespace: the namespace
+        create: create the namespace cache, if it does not exist
+        **settings: diskcache settings (eviction_policy, size_limit..) to apply to the namespace cache
+    """
+    if not hasattr(dcache, '_flex_namespaces'):
+        dcache._flex_namespaces = {}
+    ns_cache = dcache._flex_namespaces.get(namespace)
+    if ns_cache is None or any(getattr(ns_cache, k) != v for k, v in settings.items()):
+        directory = path.join(dcache.directory, 'namespaces', quote(namespace, safe=''))
+        if create or path.isdir(directory):
+            ns_cache = DCache(directory=directory, **settings)
+            if not ns_cache.tag_index:
+                ns_cache.create_tag_index()  # for invalidate_all
+            dcache._flex_namespaces[namespace] = ns_cache
+    return ns_cache
+
+
+def cull_to_limit(dcache, limit):
+    """
+    Evicts entries (by the eviction policy of dcache) until at most limit entries remain.
+    This mirrors how diskcache itself culls to its size_limit, ie. the entries to evict are selected
+    through the index of the eviction policy - so the cost is independent of the total number of keys.
+    Returns:
+        count of evicted entries
+    """
+    over = len(dcache) - limit
+    select = EVICTION_POLICY[dcache.eviction_policy]['cull']
+    if over <= 0 or select is None:
+        return 0
+    now = time()
+    with dcache._transact() as (sql, cleanup):
+        rows = sql(select.format(fields='filename', now=now), (over,)).fetchall()
+        sql('DELETE FROM Cache WHERE rowid IN (%s)' % select.format(fields='rowid', now=now), (over,))
+        for (filename,) in rows:
+            cleanup(filename)
+    return len(rows)
+
 
 class DiskCache(MemCache):
     """
     DiskCache inherits from MemCache since the underlying cache object is also dict-like.
     DiskCache must be initiated with a diskcache.Cache object to back the disk-based caching
     """
-    def __init__(self, dcache=None, prefix="rc", serializer=dumps, deserializer=loads):
-        dcache = dcache or DCache()
+    def __init__(self, dcache=None, prefix="rc", serializer=dumps, deserializer=loads, **options):
+        if dcache is None:
+            dcache = DCache()  # not `dcache or DCache()`, as an empty diskcache.Cache is falsy
+        if not dcache.tag_index:
+            dcache.create_tag_index()  # for invalidate_all and the tag indexes
         # Use BaseCache init rather than the MemCache one..
-        super(MemCache, self).__init__(DiskCacheDecorator, dcache, prefix, serializer, deserializer)
+        super(MemCache, self).__init__(DiskCacheDecorator, dcache, prefix, serializer, deserializer, **options)
+
+    def _mget_serialized(self, keys, instances):
+        # one transaction per diskcache.Cache (namespaces with limits have their own), rather than one per key
+        with self._transact(instances):
+            return super()._mget_serialized(keys, instances)
+
+    def _mset_serialized(self, outputs):
+        # BaseCache rather than MemCache, which writes to a CachedDict
+        with self._transact([instance for instance, _, _, _ in outputs]):
+            super(MemCache, self)._mset_serialized(outputs)
+
+    def _delete_keys(self, deco, keys):
+        with deco.cache.transact():
+            super(MemCache, self)._delete_keys(deco, keys)
+
+    def _invalidate_tags(self, tags):
+        dcache = self._cache
+        for tag in tags:
+            tag_key = tag_index_key(self.prefix, tag)
+            with dcache.transact():
+                # the index entries of a tag are tagged (natively) with the tag index key
+                index_keys = [row[0] for row in dcache._sql('SELECT key FROM Cache WHERE tag = ?', (tag_key,))]
+                namespaces = {index_key: dcache.pop(index_key, MISS) for index_key in index_keys}
+            for index_key, namespace in namespaces.items():
+                if namespace is MISS:
+                    continue  # expired
+                target = get_namespace_cache(dcache, namespace) if namespace is not None else dcache
+                if target is not None:
+                    target.delete(index_key[len(tag_key) + 1:])
+
+    @staticmethod
+    @contextmanager
+    def _transact(instances):
+        dcaches = {instance.cache.directory: instance.cache for instance in instances}
+        with ExitStack() as stack:
+            # in a stable order, so concurrent batches cannot deadlock
+            for directory in sorted(dcaches):
+                stack.enter_context(dcaches[directory].transact())
+            yield
 
 
 class DiskCacheDecorator(MemCacheDecorator):
-    def __init__(self, cache, prefix='rc', serializer=dumps, deserializer=loads, ttl=0, limit=0, namespace=None):
-        if limit != 0:
-            raise ValueError('DiskCache does not support limits - only ttl')
+    def __init__(self, cache, prefix='rc', serializer=dumps, deserializer=loads, ttl=0, limit=0, namespace=None,
+                 size_limit=0, eviction_policy='fifo', **kwargs):
+        """
+        Args:
+            limit: max number of entries in the namespace
+            size_limit: max size of the namespace in bytes
+            eviction_policy: fifo, lru or lfu (or a diskcache eviction policy) - used when limit or size_limit is hit
+        """
         if ttl == 0:
             ttl = None
-        super().__init__(cache, prefix, serializer, deserializer, ttl, limit, namespace)
+        # Use BaseCacheDecorator init rather than the MemCacheDecorator one, which does not support limits..
+        super(MemCacheDecorator, self).__init__(cache, prefix, serializer, deserializer, ttl, limit, namespace,
+                                                **kwargs)
+        self.root_cache = cache  # rather than the cache of a namespace with limits
+        self.size_limit = size_limit
+        self.eviction_policy = EVICTION_POLICIES.get(eviction_policy, eviction_policy)
+        if self.eviction_policy not in EVICTION_POLICY:
+            raise ValueError('Unsupported eviction policy: {}'.format(eviction_policy))
+        if namespace:
+            self._use_namespace_cache()
+
+    def _bind_function(self, fn):
+        super()._bind_function(fn)
+        self._use_namespace_cache()
+
+    def _use_namespace_cache(self):
+        settings = {}
+        if self.limit or self.size_limit:
+            settings['eviction_policy'] = self.eviction_policy
+        if self.size_limit:
+            settings['size_limit'] = self.size_limit
+        ns_cache = get_namespace_cache(self.root_cache, self.namespace, create=bool(settings), **settings)
+        if ns_cache is not None:
+            self.cache = ns_cache
+
+    def check_cache_with_ttl(self, key):
+        value, expire_time = self.cache.get(key, MISS, expire_time=True)
+        return value, None if expire_time is None else expire_time - time()
+
+    def cache_output(self, key, serialized, ttl=None):
+        # natively tagged with the namespace, for invalidate_all
+        self.cache.set(key, serialized, expire=self.ttl if ttl is None else ttl, tag=self.namespace_tag)
+        if self.limit:
+            self._count_evictions(cull_to_limit(self.cache, self.limit))
+
+    @property
+    def namespace_tag(self):
+        return f'{self.prefix}:{self.namespace}'
+
+    def invalidate_all(self, *args, **kwargs):
+        if not self.namespace:
+            return
+        self.cache.evict(self.namespace_tag)
+
+    def tag_key(self, key, tags, ttl=None):
+        # an index entry per tag & key - in the root cache, so it does not count towards the limits of the namespace.
+        # Its value is the namespace of the cache holding the key, if that is not the root cache
+        namespace = self.namespace if self.cache is not self.root_cache else None
+        ttl = self.ttl if ttl is None else ttl
+        with self.root_cache.transact():
+            for tag in tags:
+                tag_key = tag_index_key(self.prefix, tag)
+                self.root_cache.set(f'{tag_key}:{key}', namespace, expire=ttl or None, tag=tag_key)
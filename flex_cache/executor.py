@@ -0,0 +1,140 @@
+import asyncio
+import inspect
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from functools import partial
+from importlib import import_module
+from threading import Event, Lock, Thread
+from weakref import ref
+
+REFRESH_WORKERS = 4
+_refresh_executor = None
+_refresh_executor_lock = Lock()
+
+
+def default_refresh_executor():
+    """
+    Returns the thread pool refreshing stale values (see the stale_ttl option) - created on first use
+    """
+    global _refresh_executor
+    with _refresh_executor_lock:
+        if _refresh_executor is None:
+            _refresh_executor = ThreadPoolExecutor(REFRESH_WORKERS, thread_name_prefix='flex_cache-refresh')
+        return _refresh_executor
+
+
+class PeriodicThread(Thread):
+    """
+    Daemon thread calling the method (name) of owner every interval seconds - the reaper of a CachedDict, or the
+    ticker of a RefreshAheadScheduler.
+    Only holds a weak reference to owner, so it stops once owner is garbage collected
+    """
+    def __init__(self, owner, method, interval, name):
+        super().__init__(name=name, daemon=True)
+        self.owner = ref(owner)
+        self.method = method
+        self.interval = interval
+        self.stopped = Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            owner = self.owner()
+            if owner is None:
+                return
+            getattr(owner, self.method)()
+            del owner
+
+    def stop(self):
+        self.stopped.set()
+
+
+def call_original(module, qualname, args, kwargs):
+    """
+    Calls the original (undecorated) function of the cached function module.qualname.
+    Used to compute misses in a process pool, since the original function cannot be pickled by reference - its name
+    refers to the cached function.
+    """
+    fn = import_module(module)
+    for name in qualname.split('.'):
+        fn = getattr(fn, name)
+    return fn.instance.original_fn(*args, **kwargs)
+
+
+def run_calls(calls, executor=None, max_concurrency=0):
+    """
+    Calls the original functions of cached functions, and returns their results in the order of calls.
+    Args:
+        calls: list of (cached function, args, kwargs)
+        executor: None (call sequentially), a concurrent.futures.Executor - eg. a ThreadPoolExecutor for I/O bound
+            functions, or a ProcessPoolExecutor for CPU bound (module level) functions - or an asyncio event loop,
+            which awaits coroutine functions and runs other functions in its default executor
+        max_concurrency: max number of calls in progress at a time - 0 means no limit (beyond the executor's own)
+    """
+    if executor is None:
+        return [fn.instance.original_fn(*args, **kwargs) for fn, args, kwargs in calls]
+    if isinstance(executor, asyncio.AbstractEventLoop):
+        return _run_in_loop(calls, executor, max_concurrency)
+    return _run_in_executor(calls, executor, max_concurrency)
+
+
+def _run_in_executor(calls, executor, max_concurrency):
+    results = [None] * len(calls)
+    indexes = {}
+    pending = set()
+
+    def collect(done):
+        for future in done:
+            results[indexes.pop(future)] = future.result()
+
+    try:
+        for i, (fn, args, kwargs) in enumerate(calls):
+            if isinstance(executor, ProcessPoolExecutor):
+                future = executor.submit(call_original, fn.__module__, fn.__qualname__, args, kwargs)
+            else:
+                future = executor.submit(fn.instance.original_fn, *args, **kwargs)
+            indexes[future] = i
+            pending.add(future)
+            if max_concurrency and len(pending) >= max_concurrency:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                collect(done)
+        done, pending = wait(pending)
+        collect(done)
+    except BaseException:
+        for future in pending:
+            future.cancel()
+        raise
+    return results
+
+
+def _run_in_loop(calls, loop, max_concurrency):
+    try:
+        running = asyncio.get_running_loop()
+    except RuntimeError:
+        running = None
+    if running is loop:
+        raise RuntimeError('Cannot block the running event loop - await the calls instead')
+    coro = gather_calls(calls, max_concurrency)
+    if loop.is_running():
+        return asyncio.run_coroutine_threadsafe(coro, loop).result()
+    return loop.run_until_complete(coro)
+
+
+async def gather_calls(calls, max_concurrency=0):
+    """
+    Awaits the original functions of cached functions concurrently (at most max_concurrency at a time, if > 0),
+    and returns their results in the order of calls. Functions which are not coroutine functions are run in the
+    default executor of the loop.
+    """
+    loop = asyncio.get_running_loop()
+    semaphore = asyncio.Semaphore(max_concurrency) if max_concurrency else None
+
+    async def call(fn, args, kwargs):
+        original_fn = fn.instance.original_fn
+        if inspect.iscoroutinefunction(original_fn):
+            return await original_fn(*args, **kwargs)
+        return await loop.run_in_executor(None, partial(original_fn, *args, **kwargs))
+
+    async def bounded_call(fn, args, kwargs):
+        async with semaphore:
+            return await call(fn, args, kwargs)
+
+    return await asyncio.gather(*[(bounded_call if semaphore else call)(*c) for c in calls])
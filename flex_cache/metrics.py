@@ -0,0 +1,175 @@
+from bisect import bisect_left
+from collections import namedtuple
+from functools import wraps
+from threading import Lock, current_thread, local
+from time import perf_counter
+from weakref import finalize
+
+# upper bounds (in seconds) of the latency histogram buckets
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+PHASES = ('read', 'write', 'compute')
+
+CacheInfo = namedtuple('CacheInfo', 'hits misses sets evictions errors read write compute')
+# buckets: count of observations per bucket of LATENCY_BUCKETS (+ one for those above the last bound)
+Latency = namedtuple('Latency', 'count sum buckets')
+
+
+class Counters(object):
+    """
+    Counters of a namespace, updated by a single thread - so they need no locks
+    """
+    __slots__ = ('hits', 'misses', 'sets', 'evictions', 'errors', 'latencies')
+
+    def __init__(self):
+        self.hits = self.misses = self.sets = self.evictions = self.errors = 0
+        # phase: [sum, count per bucket..]
+        self.latencies = {phase: [0.0] + [0] * (len(LATENCY_BUCKETS) + 1) for phase in PHASES}
+
+    def observe(self, phase, seconds):
+        latency = self.latencies[phase]
+        latency[0] += seconds
+        latency[bisect_left(LATENCY_BUCKETS, seconds) + 1] += 1
+
+    def __add__(self, other):
+        total = Counters()
+        for name in ('hits', 'misses', 'sets', 'evictions', 'errors'):
+            setattr(total, name, getattr(self, name) + getattr(other, name))
+        for phase in PHASES:
+            total.latencies[phase] = [a + b for a, b in zip(self.latencies[phase], other.latencies[phase])]
+        return total
+
+
+class NamespaceMetrics(object):
+    """
+    Hit, miss, set, eviction & error counters and read, write & compute latency histograms of a namespace.
+    Each thread updates its own Counters, which are summed by snapshot() - the Counters of a thread are folded into
+    the retired total once the thread is gone, so short lived threads do not pile up Counters
+    """
+    def __init__(self, namespace):
+        self.namespace = namespace
+        self._local = local()
+        self._counters = []  # of the live threads
+        self._retired = Counters()  # of the dead threads - replaced (never updated) so snapshots stay consistent
+        self._lock = Lock()
+
+    def counters(self):
+        try:
+            return self._local.counters
+        except AttributeError:
+            counters = self._local.counters = Counters()
+            with self._lock:
+                self._counters.append(counters)
+            finalize(current_thread(), self._retire, counters)
+            return counters
+
+    def _retire(self, counters):
+        with self._lock:
+            self._counters.remove(counters)
+            self._retired = self._retired + counters
+
+    def timed(self, fn, phase, on_result=None):
+        """
+        Returns fn, timed as phase - on_result(counters, result) is called with its results
+        """
+        @wraps(fn)
+        def timed_fn(*args, **kwargs):
+            counters = self.counters()
+            start = perf_counter()
+            try:
+                result = fn(*args, **kwargs)
+            except Exception:
+                counters.errors += 1
+                raise
+            finally:
+                counters.observe(phase, perf_counter() - start)
+            if on_result is not None:
+                on_result(counters, result)
+            return result
+        return timed_fn
+
+    def atimed(self, fn, phase, on_result=None):
+        """
+        timed, for coroutine functions
+        """
+        @wraps(fn)
+        async def timed_fn(*args, **kwargs):
+            counters = self.counters()
+            start = perf_counter()
+            try:
+                result = await fn(*args, **kwargs)
+            except Exception:
+                counters.errors += 1
+                raise
+            finally:
+                counters.observe(phase, perf_counter() - start)
+            if on_result is not None:
+                on_result(counters, result)
+            return result
+        return timed_fn
+
+    def snapshot(self):
+        """
+        Returns the CacheInfo of the namespace
+        """
+        with self._lock:
+            all_counters = self._counters + [self._retired]
+        totals = [sum(getattr(c, name) for c in all_counters) for name in ('hits', 'misses', 'sets', 'evictions',
+                                                                            'errors')]
+        latencies = []
+        for phase in PHASES:
+            summed = [sum(values) for values in zip(*(c.latencies[phase] for c in all_counters))]
+            latencies.append(Latency(sum(summed[1:]), summed[0], tuple(summed[1:])))
+        return CacheInfo(*totals, *latencies)
+
+
+class MetricsRegistry(object):
+    """
+    The NamespaceMetrics of a cache
+    """
+    def __init__(self):
+        self.namespaces = {}
+        self._lock = Lock()
+
+    def namespace(self, namespace):
+        with self._lock:
+            metrics = self.namespaces.get(namespace)
+            if metrics is None:
+                metrics = self.namespaces[namespace] = NamespaceMetrics(namespace)
+            return metrics
+
+    def snapshot(self):
+        """
+        Returns the CacheInfo of each namespace, as {namespace: CacheInfo}
+        """
+        with self._lock:
+            namespaces = dict(self.namespaces)
+        return {namespace: metrics.snapshot() for namespace, metrics in namespaces.items()}
+
+    def prometheus(self, prefix='flex_cache'):
+        """
+        Returns the metrics in the Prometheus text exposition format
+        """
+        snapshot = self.snapshot()
+        lines = []
+        for name in ('hits', 'misses', 'sets', 'evictions', 'errors'):
+            lines.append(f'# TYPE {prefix}_{name}_total counter')
+            for namespace, info in snapshot.items():
+                lines.append(f'{prefix}_{name}_total{{namespace="{_escape(namespace)}"}} {getattr(info, name)}')
+        for phase in PHASES:
+            metric = f'{prefix}_{phase}_seconds'
+            lines.append(f'# TYPE {metric} histogram')
+            for namespace, info in snapshot.items():
+                label = f'namespace="{_escape(namespace)}"'
+                latency = getattr(info, phase)
+                cumulative = 0
+                for bound, count in zip(LATENCY_BUCKETS, latency.buckets):
+                    cumulative += count
+                    lines.append(f'{metric}_bucket{{{label},le="{bound}"}} {cumulative}')
+                lines.append(f'{metric}_bucket{{{label},le="+Inf"}} {latency.count}')
+                lines.append(f'{metric}_sum{{{label}}} {latency.sum}')
+                lines.append(f'{metric}_count{{{label}}} {latency.count}')
+        return '\n'.join(lines) + '\n'
+
+
+def _escape(label):
+    return str(label).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
@@ -1,19 +1,23 @@
 from json import dumps, loads
 from functools import wraps
-from .basecache import BaseCache, BaseCacheDecorator
+from .basecache import BaseCache, BaseCacheDecorator, MISS
 
 
 class NoCache(BaseCache):
-    def __init__(self, prefix="rc", serializer=dumps, deserializer=loads):
-        super().__init__(NoCacheDecorator, dict(), prefix, serializer, deserializer)
+    def __init__(self, prefix="rc", serializer=dumps, deserializer=loads, **options):
+        super().__init__(NoCacheDecorator, dict(), prefix, serializer, deserializer, **options)
 
     def mget(self, *fns_with_args):
         raise NotImplementedError('This is not a real cache..')
 
+    def _invalidate_tags(self, tags):
+        pass  # nothing is cached
+
 
 class NoCacheDecorator(BaseCacheDecorator):
 
     def __call__(self, fn):
+        self._bind_function(fn)
 
         @wraps(fn)
         def inner(*args, **kwargs):
@@ -21,13 +25,14 @@ class NoCacheDecorator(BaseCacheDecorator):
 
         inner.invalidate = self.invalidate
         inner.invalidate_all = self.invalidate_all
+        inner.cache_info = self.cache_info
         inner.instance = self
         return inner
 
     def check_cache(self, key):
-        return None
+        return MISS
 
-    def cache_output(self, key, serialized):
+    def cache_output(self, key, serialized, ttl=None):
         pass
 
     def invalidate_key(self, key):
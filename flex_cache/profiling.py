@@ -0,0 +1,103 @@
+import inspect
+from collections import namedtuple
+from contextvars import ContextVar
+from functools import wraps
+from random import random
+from time import perf_counter
+
+# size: bytes (or chars) of the payload of the phase - None if not applicable
+Phase = namedtuple('Phase', 'name seconds size')
+
+_current = ContextVar('flex_cache_profile', default=None)
+
+
+class CallProfile(object):
+    """
+    The phases of a sampled cached call (name is its namespace) or bulk call (name is 'mget', 'get_many', 'set_many'
+    or 'delete_many') - in the order they ended, ie. nested phases (filter_args within key) come first.
+    Phases: key, filter_args, backend_read, deserialize, compute, serialize, backend_write - and for mget,
+    compute_misses (computing all missing results)
+    """
+    __slots__ = ('name', 'phases', 'seconds')
+
+    def __init__(self, name):
+        self.name = name
+        self.phases = []
+        self.seconds = 0
+
+    def __repr__(self):
+        return '<CallProfile {} {:.6f}s {}>'.format(self.name, self.seconds, self.phases)
+
+
+class Profiler(object):
+    """
+    Reports the CallProfile of sampled cached calls to callback - eg. a function feeding a tracing system, with a span
+    per phase. sample_rate is the fraction of calls profiled.
+    Decorators only wrap their phases with a profiler, so functions without one do not pay for profiling
+    """
+    def __init__(self, callback, sample_rate=1.0):
+        self.callback = callback
+        self.sample_rate = sample_rate
+
+    def profiled(self, fn, name):
+        """
+        Returns fn (a cached function, or mget) - profiling sampled calls
+        """
+        if inspect.iscoroutinefunction(fn):
+            @wraps(fn)
+            async def aprofiled_fn(*args, **kwargs):
+                if random() >= self.sample_rate:
+                    return await fn(*args, **kwargs)
+                profile = CallProfile(name)
+                token = _current.set(profile)
+                start = perf_counter()
+                try:
+                    return await fn(*args, **kwargs)
+                finally:
+                    profile.seconds = perf_counter() - start
+                    _current.reset(token)
+                    self.callback(profile)
+            return aprofiled_fn
+
+        @wraps(fn)
+        def profiled_fn(*args, **kwargs):
+            if random() >= self.sample_rate:
+                return fn(*args, **kwargs)
+            profile = CallProfile(name)
+            token = _current.set(profile)
+            start = perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                profile.seconds = perf_counter() - start
+                _current.reset(token)
+                self.callback(profile)
+        return profiled_fn
+
+    def phase(self, fn, name, size=None):
+        """
+        Returns fn - recording its duration as phase name of the profiled call (if any), and the payload size
+        returned by size(args, result)
+        """
+        if inspect.iscoroutinefunction(fn):
+            @wraps(fn)
+            async def aphase_fn(*args, **kwargs):
+                profile = _current.get()
+                if profile is None:
+                    return await fn(*args, **kwargs)
+                start = perf_counter()
+                result = await fn(*args, **kwargs)
+                profile.phases.append(Phase(name, perf_counter() - start, size(args, result) if size else None))
+                return result
+            return aphase_fn
+
+        @wraps(fn)
+        def phase_fn(*args, **kwargs):
+            profile = _current.get()
+            if profile is None:
+                return fn(*args, **kwargs)
+            start = perf_counter()
+            result = fn(*args, **kwargs)
+            profile.phases.append(Phase(name, perf_counter() - start, size(args, result) if size else None))
+            return result
+        return phase_fn
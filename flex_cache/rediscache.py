@@ -1,98 +1,345 @@
 from json import dumps, loads
-from .basecache import BaseCache, BaseCacheDecorator
+from time import time, sleep
+from uuid import uuid4
+from .basecache import BaseCache, BaseCacheDecorator, MISS, tag_index_key
+from .serializers import is_binary
+
+
+EVICTION_POLICIES = ('fifo', 'lru', 'lfu')
+INVALIDATE_CHUNK_SIZE = 500
+
+
+def check_binary_client(client):
+    """
+    Raises ValueError if the redis client decodes responses - binary (eg. compressed) values cannot be decoded as text
+    """
+    if client.connection_pool.connection_kwargs.get('decode_responses'):
+        raise ValueError('Binary values (of a codec or binary serializer) need decode_responses=False')
 
 
 def get_cache_lua_fn(client):
+    """
+    Sets KEYS[1] to ARGV[1] (expiring after ARGV[2] seconds, if > 0 - fractions are kept, as the key is set with
+    a ttl in milliseconds), and indexes the key in the sorted set KEYS[2].
+    If ARGV[3] (limit) > 0, the lowest scored keys beyond the limit are evicted - the score is the time of the set for
+    fifo/lru, or the number of sets & reads for lfu (ARGV[4]). Otherwise the score is the expiry time of the key, so
+    expired keys are dropped from the index on sets. The index expires with the last key expiring.
+    Returns the number of evicted keys
+    """
     if not hasattr(client, '_lua_cache_fn'):
         client._lua_cache_fn = client.register_script("""
 local ttl = tonumber(ARGV[2])
-local value
+local ttl_ms = math.max(1, math.floor(ttl * 1000 + 0.5))
+local evicted = 0
 if ttl > 0 then
-  value = redis.call('SETEX', KEYS[1], ttl, ARGV[1])
+  redis.call('SET', KEYS[1], ARGV[1], 'PX', ttl_ms)
 else
-  value = redis.call('SET', KEYS[1], ARGV[1])
+  redis.call('SET', KEYS[1], ARGV[1])
 end
+local index_ttl = redis.call('PTTL', KEYS[2])
+local time_parts = redis.call('TIME')
 local limit = tonumber(ARGV[3])
 if limit > 0 then
-  local time_parts = redis.call('TIME')
-  local time = tonumber(time_parts[1] .. '.' .. time_parts[2])
-  redis.call('ZADD', KEYS[2], time, KEYS[1])
-  local count = tonumber(redis.call('ZCOUNT', KEYS[2], '-inf', '+inf'))
-  local over = count - limit
-  if over > 0 then
-    local stale_keys_and_scores = redis.call('ZPOPMIN', KEYS[2], over)
-    -- Remove the the scores and just leave the keys
-    local stale_keys = {}
-    for i = 1, #stale_keys_and_scores, 2 do
-      stale_keys[#stale_keys+1] = stale_keys_and_scores[i]
+  -- evict before indexing the key, so a new key cannot evict itself
+  if not redis.call('ZSCORE', KEYS[2], KEYS[1]) then
+    local over = redis.call('ZCARD', KEYS[2]) - limit + 1
+    if over > 0 then
+      local popped = redis.call('ZPOPMIN', KEYS[2], over)
+      local stale_keys = {}
+      for i = 1, #popped, 2 do
+        stale_keys[#stale_keys+1] = popped[i]
+      end
+      evicted = redis.call('DEL', unpack(stale_keys))
     end
-    redis.call('ZREM', KEYS[2], unpack(stale_keys))
-    redis.call('DEL', unpack(stale_keys))
   end
+  if ARGV[4] == 'lfu' then
+    redis.call('ZINCRBY', KEYS[2], 1, KEYS[1])
+  else
+    redis.call('ZADD', KEYS[2], time_parts[1] .. '.' .. string.format('%06d', time_parts[2]), KEYS[1])
+  end
+else
+  local now = tonumber(time_parts[1]) + tonumber(time_parts[2]) / 1000000
+  redis.call('ZREMRANGEBYSCORE', KEYS[2], '-inf', '(' .. now)
+  redis.call('ZADD', KEYS[2], ttl > 0 and now + ttl or '+inf', KEYS[1])
 end
-return value
+-- the index must outlive its keys: -1 means it never expires, -2 that it did not exist
+if ttl <= 0 then
+  redis.call('PERSIST', KEYS[2])
+elseif index_ttl ~= -1 and index_ttl < ttl_ms then
+  redis.call('PEXPIRE', KEYS[2], ttl_ms)
+end
+return evicted
 """)
     return client._lua_cache_fn
 
 
-# Utility function to batch keys
-def chunks(iterable, n):
-    """Yield successive n-sized chunks from iterator."""
-    _iterable = iter(iterable)
-    while True:
-        elements = []
-        for _ in range(n):
-            try:
-                elements.append(next(_iterable))
-            except StopIteration:
-                break
+def get_touch_lua_fn(client):
+    """
+    Returns the value of KEYS[1] - and if present, updates its score in the sorted set KEYS[2] (if indexed there),
+    ie. the time of the read for lru, or the number of sets & reads for lfu (ARGV[1])
+    """
+    if not hasattr(client, '_lua_touch_fn'):
+        client._lua_touch_fn = client.register_script("""
+local value = redis.call('GET', KEYS[1])
+if value then
+  if ARGV[1] == 'lfu' then
+    redis.call('ZADD', KEYS[2], 'XX', 'INCR', 1, KEYS[1])
+  else
+    local time_parts = redis.call('TIME')
+    redis.call('ZADD', KEYS[2], 'XX', time_parts[1] .. '.' .. string.format('%06d', time_parts[2]), KEYS[1])
+  end
+end
+return value
+""")
+    return client._lua_touch_fn
+
+
+def get_ttl_lua_fn(client):
+    """
+    Returns the value of KEYS[1] and its remaining ttl in milliseconds (-1 if it does not expire), as {value, ttl}.
+    If ARGV[1] is lru or lfu, the score of the key in the sorted set KEYS[2] is updated, as by get_touch_lua_fn
+    """
+    if not hasattr(client, '_lua_ttl_fn'):
+        client._lua_ttl_fn = client.register_script("""
+local value = redis.call('GET', KEYS[1])
+if not value then
+  return {false, -2}
+end
+if ARGV[1] == 'lfu' then
+  redis.call('ZADD', KEYS[2], 'XX', 'INCR', 1, KEYS[1])
+elseif ARGV[1] == 'lru' then
+  local time_parts = redis.call('TIME')
+  redis.call('ZADD', KEYS[2], 'XX', time_parts[1] .. '.' .. string.format('%06d', time_parts[2]), KEYS[1])
+end
+return {value, redis.call('PTTL', KEYS[1])}
+""")
+    return client._lua_ttl_fn
 
-        if not len(elements):
-            break
 
-        yield elements
+def get_drain_lua_fn(client):
+    """
+    Pops up to ARGV[1] keys off the index (sorted set) KEYS[1], and unlinks them
+    Returns:
+        count of popped keys
+    """
+    if not hasattr(client, '_lua_drain_fn'):
+        client._lua_drain_fn = client.register_script("""
+local popped = redis.call('ZPOPMIN', KEYS[1], ARGV[1])
+local keys = {}
+for i = 1, #popped, 2 do
+  keys[#keys+1] = popped[i]
+end
+if #keys > 0 then
+  redis.call('UNLINK', unpack(keys))
+end
+return #keys
+""")
+    return client._lua_drain_fn
+
+
+def get_tag_lua_fn(client):
+    """
+    Tags the key ARGV[1] of the namespace indexed in ARGV[3] (its keys_key) with the tags of the tag indexes KEYS.
+    A tag index (set) holds the keys_keys of the namespaces with tagged keys, and the tagged keys of each namespace are
+    in the set {tag index}:{keys_key} - so invalidating a tag can drop the keys from their namespace index too.
+    The sets expire with the last key expiring (ARGV[2] seconds, if > 0)
+    """
+    if not hasattr(client, '_lua_tag_fn'):
+        client._lua_tag_fn = client.register_script("""
+local ttl = tonumber(ARGV[2])
+local ttl_ms = math.max(1, math.floor(ttl * 1000 + 0.5))
+local function add(set_key, member)
+  local set_ttl = redis.call('PTTL', set_key)
+  redis.call('SADD', set_key, member)
+  if ttl <= 0 then
+    redis.call('PERSIST', set_key)
+  elseif set_ttl ~= -1 and set_ttl < ttl_ms then
+    redis.call('PEXPIRE', set_key, ttl_ms)
+  end
+end
+for _, tag_key in ipairs(KEYS) do
+  add(tag_key, ARGV[3])
+  add(tag_key .. ':' .. ARGV[3], ARGV[1])
+end
+""")
+    return client._lua_tag_fn
+
+
+def get_tag_drain_lua_fn(client):
+    """
+    Pops up to ARGV[1] keys tagged with the tag index KEYS[1] off the namespace indexed in ARGV[2] (its keys_key) -
+    and unlinks them, and drops them from the namespace index. Once the namespace has no more tagged keys, it is
+    dropped from the tag index
+    Returns:
+        count of popped keys
+    """
+    if not hasattr(client, '_lua_tag_drain_fn'):
+        client._lua_tag_drain_fn = client.register_script("""
+local namespace_tag_key = KEYS[1] .. ':' .. ARGV[2]
+local keys = redis.call('SPOP', namespace_tag_key, ARGV[1])
+if #keys > 0 then
+  redis.call('UNLINK', unpack(keys))
+  redis.call('ZREM', ARGV[2], unpack(keys))
+end
+if redis.call('SCARD', namespace_tag_key) == 0 then
+  redis.call('SREM', KEYS[1], ARGV[2])
+end
+return #keys
+""")
+    return client._lua_tag_drain_fn
+
+
+def get_lease_lua_fn(client):
+    """
+    Returns the cached value if present - otherwise tries to acquire the recompute lease (KEYS[2]) for ARGV[2] ms
+    Returns:
+        [value or None, 1 if the lease was acquired else 0]
+    """
+    if not hasattr(client, '_lua_lease_fn'):
+        client._lua_lease_fn = client.register_script("""
+local value = redis.call('GET', KEYS[1])
+if value then
+  return {value, 0}
+end
+if redis.call('SET', KEYS[2], ARGV[1], 'NX', 'PX', ARGV[2]) then
+  return {false, 1}
+end
+return {false, 0}
+""")
+    return client._lua_lease_fn
+
+
+def get_release_lua_fn(client):
+    """
+    Releases the recompute lease (KEYS[1]), if it is still held by the token in ARGV[1]
+    """
+    if not hasattr(client, '_lua_release_fn'):
+        client._lua_release_fn = client.register_script("""
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+  return redis.call('DEL', KEYS[1])
+end
+return 0
+""")
+    return client._lua_release_fn
 
 
 class RedisCache(BaseCache):
-    def __init__(self, redis_client, prefix="rc", serializer=dumps, deserializer=loads):
-        super().__init__(RedisCacheDecorator, redis_client, prefix, serializer, deserializer)
+    def __init__(self, redis_client, prefix="rc", serializer=dumps, deserializer=loads, **options):
+        super().__init__(RedisCacheDecorator, redis_client, prefix, serializer, deserializer, **options)
 
-    def mget(self, *fns_with_args):
-        keys = self.mget_keys(*fns_with_args)
-        results = self._cache.mget(*keys)
-        pipeline = self._cache.pipeline()
+    def _mget_serialized(self, keys, instances):
+        if any(instance.touch_on_read for instance in instances):
+            pipeline = self._cache.pipeline(transaction=False)
+            for key, instance in zip(keys, instances):
+                if instance.touch_on_read:
+                    get_touch_lua_fn(self._cache)(keys=[key, instance.keys_key], args=[instance.eviction_policy],
+                                                  client=pipeline)
+                else:
+                    pipeline.get(key)
+            results = pipeline.execute()
+        else:
+            results = self._cache.mget(*keys)
+        return [MISS if result is None else result for result in results]
 
-        deserialized_results = []
-        needs_pipeline = False
-        for i, result in enumerate(results):
-            if result is None:
-                needs_pipeline = True
+    def _mset_serialized(self, outputs):
+        pipeline = self._cache.pipeline()
+        for instance, key, serialized, ttl in outputs:
+            ttl = instance.ttl if ttl is None else ttl
+            get_cache_lua_fn(self._cache)(keys=[key, instance.keys_key],
+                                          args=[serialized, ttl, instance.limit, instance.eviction_policy],
+                                          client=pipeline)
+        pipeline.execute()
 
-                fn_and_args = fns_with_args[i]
-                fn = fn_and_args['fn']
-                args = fn_and_args['args'] if 'args' in fn_and_args else []
-                kwargs = fn_and_args['kwargs'] if 'kwargs' in fn_and_args else {}
-                result = fn.instance.original_fn(*args, **kwargs)
-                result_serialized = self.serializer(result)
-                get_cache_lua_fn(self._cache)(keys=[keys[i], fn.instance.keys_key], args=[result_serialized, fn.instance.ttl, fn.instance.limit], client=pipeline)
-            else:
-                result = self.deserializer(result)
-            deserialized_results.append(result)
+    def _invalidate_tags(self, tags):
+        drain = get_tag_drain_lua_fn(self._cache)
+        for tag in tags:
+            tag_key = tag_index_key(self.prefix, tag)
+            for keys_key in self._cache.smembers(tag_key):
+                args = [INVALIDATE_CHUNK_SIZE, keys_key]
+                while drain(keys=[tag_key], args=args) == INVALIDATE_CHUNK_SIZE:
+                    pass
 
-        if needs_pipeline:
-            pipeline.execute()
-        return deserialized_results
+    def _delete_keys(self, deco, keys):
+        pipeline = self._cache.pipeline()
+        pipeline.delete(*keys)
+        pipeline.zrem(deco.keys_key, *keys)
+        pipeline.execute()
 
 
 class RedisCacheDecorator(BaseCacheDecorator):
-    def __init__(self, redis_client, prefix="rc", serializer=dumps, deserializer=loads, ttl=0, limit=0, namespace=None):
-        super().__init__(redis_client, prefix, serializer, deserializer, ttl, limit, namespace)
+    def __init__(self, redis_client, prefix="rc", serializer=dumps, deserializer=loads, ttl=0, limit=0, namespace=None,
+                 lease_ttl=0, lease_poll_interval=0.05, eviction_policy='fifo', **kwargs):
+        """
+        Args:
+            lease_ttl: if > 0, a worker must hold a recompute lease (expiring after lease_ttl seconds) to compute a
+                       missing value - other workers poll for the value (for up to lease_ttl seconds) meanwhile
+            lease_poll_interval: seconds between polls, while waiting for the lease holder
+            eviction_policy: fifo, lru or lfu - which keys are evicted, once limit is hit
+        """
+        super().__init__(redis_client, prefix, serializer, deserializer, ttl, limit, namespace, **kwargs)
+        if self.codec or is_binary(serializer):
+            check_binary_client(redis_client)
+        self.lease_ttl = lease_ttl
+        self.lease_poll_interval = lease_poll_interval
+        if eviction_policy not in EVICTION_POLICIES:
+            raise ValueError('Unsupported eviction policy: {}'.format(eviction_policy))
+        self.eviction_policy = eviction_policy
+        # lru & lfu update the score of keys on reads
+        self.touch_on_read = bool(limit) and eviction_policy != 'fifo'
+
+    def _fill(self, key, args, kwargs):
+        if not self.lease_ttl:
+            return self._compute(key, args, kwargs)
+        lease_key = f'{key}:lease'
+        token = uuid4().hex
+        deadline = time() + self.lease_ttl
+        while time() < deadline:
+            result, acquired = get_lease_lua_fn(self.cache)(keys=[key, lease_key],
+                                                            args=[token, int(self.lease_ttl * 1000)])
+            if result is not None:
+                return self._load(result)
+            if acquired:
+                try:
+                    return self._compute(key, args, kwargs)
+                finally:
+                    get_release_lua_fn(self.cache)(keys=[lease_key], args=[token])
+            sleep(self.lease_poll_interval)
+        # the lease holder is still computing, or has crashed - give up waiting
+        return self._compute(key, args, kwargs)
 
     def check_cache(self, key):
-        return self.cache.get(key)
+        if self.touch_on_read:
+            result = get_touch_lua_fn(self.cache)(keys=[key, self.keys_key], args=[self.eviction_policy])
+        else:
+            result = self.cache.get(key)
+        return MISS if result is None else result
+
+    def check_cache_with_ttl(self, key):
+        policy = self.eviction_policy if self.touch_on_read else ''
+        result, ttl = get_ttl_lua_fn(self.cache)(keys=[key, self.keys_key], args=[policy])
+        if result is None:
+            return MISS, None
+        return result, None if ttl < 0 else ttl / 1000
+
+    def _acquire_refresh(self, key):
+        # a refresh lock next to the value, so one worker - in any process or host - refreshes a stale value
+        token = uuid4().hex
+        if self.cache.set(f'{key}:refresh', token, nx=True, px=int((self.ttl + self.stale_ttl) * 1000)):
+            return token
+        return None
+
+    def _release_refresh(self, key, token):
+        get_release_lua_fn(self.cache)(keys=[f'{key}:refresh'], args=[token])
+
+    def cache_output(self, key, serialized, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        self._count_evictions(get_cache_lua_fn(self.cache)(keys=[key, self.keys_key],
+                                                           args=[serialized, ttl, self.limit, self.eviction_policy]))
 
-    def cache_output(self, key, serialized):
-        get_cache_lua_fn(self.cache)(keys=[key, self.keys_key], args=[serialized, self.ttl, self.limit])
+    def tag_key(self, key, tags, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        get_tag_lua_fn(self.cache)(keys=[tag_index_key(self.prefix, tag) for tag in tags],
+                                   args=[key, ttl, self.keys_key])
 
     def invalidate_key(self, key):
         pipe = self.cache.pipeline()
@@ -101,6 +348,8 @@ class RedisCacheDecorator(BaseCacheDecorator):
         pipe.execute()
 
     def invalidate_all(self, *args, **kwargs):
-        chunks_gen = chunks(self.cache.scan_iter(f'{self.prefix}:{self.namespace}:*'), 500)
-        for keys in chunks_gen:
-            self.cache.delete(*keys)
+        # the keys of the namespace are indexed in keys_key - so no need to scan the keyspace
+        drain = get_drain_lua_fn(self.cache)
+        # redis deletes the index once it is drained - keys indexed meanwhile by other writers are kept (indexed)
+        while drain(keys=[self.keys_key], args=[INVALIDATE_CHUNK_SIZE]) == INVALIDATE_CHUNK_SIZE:
+            pass
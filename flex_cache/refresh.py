@@ -0,0 +1,112 @@
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from heapq import heapify, heappush, heappop
+from itertools import count
+from threading import Lock
+from time import time
+from .executor import PeriodicThread
+
+# the heap of due refreshes is compacted once it holds this many more entries than twice the tracked keys
+COMPACT_SLACK = 64
+
+
+class TrackedKey(object):
+    __slots__ = ('decorator', 'key', 'args', 'kwargs', 'refresh_at', 'hits')
+
+    def __init__(self, decorator, key, args, kwargs, refresh_at):
+        self.decorator = decorator
+        self.key = key
+        self.args = args
+        self.kwargs = kwargs
+        self.refresh_at = refresh_at
+        self.hits = 0
+
+
+class RefreshAheadScheduler(object):
+    """
+    Recomputes hot keys shortly before they expire, so callers never miss on them.
+    Functions decorated with refresh_ahead=scheduler register the keys they compute - with the arguments of the call -
+    and count the hits of the keys. lead_time seconds before a key expires, it is recomputed (by a pool of max_workers
+    threads) if it had at least min_hits hits since it was computed - otherwise it is no longer tracked, and left to
+    expire. At most max_keys keys are tracked - the least recently computed are dropped first.
+    """
+    def __init__(self, max_workers=4, max_keys=1000, min_hits=2, lead_time=1, interval=0.5):
+        self.max_keys = max_keys
+        self.min_hits = min_hits
+        self.lead_time = lead_time
+        self.keys = OrderedDict()  # (decorator, key): TrackedKey - least recently computed first
+        self.due = []  # heap of (refresh time, sequence no, TrackedKey)
+        self.sequence = count()
+        self.lock = Lock()
+        self.executor = ThreadPoolExecutor(max_workers, thread_name_prefix='flex_cache-refresh-ahead')
+        self.ticker = PeriodicThread(self, 'run_due', interval, 'flex_cache-refresh-ahead')
+        self.ticker.start()
+
+    def computed(self, decorator, key, args, kwargs, ttl):
+        """
+        Tracks key, computed by decorator from args & kwargs, and cached for ttl seconds
+        """
+        if not ttl:
+            return  # never expires
+        refresh_at = time() + ttl - min(self.lead_time, ttl / 2)
+        with self.lock:
+            tracked = self.keys.pop((decorator, key), None)
+            if tracked is None:
+                tracked = TrackedKey(decorator, key, args, kwargs, refresh_at)
+            else:
+                tracked.args, tracked.kwargs, tracked.refresh_at, tracked.hits = args, kwargs, refresh_at, 0
+            self.keys[(decorator, key)] = tracked
+            if len(self.keys) > self.max_keys:
+                self.keys.popitem(last=False)
+            heappush(self.due, (refresh_at, next(self.sequence), tracked))
+            if len(self.due) > 2 * len(self.keys) + COMPACT_SLACK:
+                self._compact()
+
+    def _compact(self):
+        """
+        Drops the heap entries of keys computed again or no longer tracked - so the heap stays bounded by max_keys,
+        rather than growing with every computation. The lock must be held
+        """
+        self.due = [(refresh_at, sequence, tracked) for refresh_at, sequence, tracked in self.due
+                    if tracked.refresh_at == refresh_at and self.keys.get((tracked.decorator, tracked.key)) is tracked]
+        heapify(self.due)
+
+    def hit(self, decorator, key):
+        tracked = self.keys.get((decorator, key))
+        if tracked is not None:
+            tracked.hits += 1  # not locked - the count only needs to be approximate
+
+    def run_due(self):
+        """
+        Submits the refreshes of hot keys due for a refresh, and stops tracking cold ones
+        """
+        now = time()
+        refresh = []
+        with self.lock:
+            while self.due and self.due[0][0] <= now:
+                refresh_at, _, tracked = heappop(self.due)
+                id_ = (tracked.decorator, tracked.key)
+                if tracked.refresh_at != refresh_at or self.keys.get(id_) is not tracked:
+                    continue  # computed again since, or no longer tracked
+                if tracked.hits >= self.min_hits:
+                    refresh.append(tracked)
+                else:
+                    del self.keys[id_]
+        for tracked in refresh:
+            self.executor.submit(self._refresh, tracked)
+
+    def _refresh(self, tracked):
+        try:
+            # tracks the key again - with its new expiry
+            tracked.decorator._compute(tracked.key, tracked.args, tracked.kwargs)
+        except Exception:
+            with self.lock:
+                if self.keys.get((tracked.decorator, tracked.key)) is tracked:
+                    del self.keys[(tracked.decorator, tracked.key)]
+
+    def __len__(self):
+        return len(self.keys)
+
+    def close(self):
+        self.ticker.stop()
+        self.executor.shutdown(wait=True)
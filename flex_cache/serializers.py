@@ -0,0 +1,70 @@
+import json
+import pickle
+try:
+    import msgpack
+except ImportError:  # msgpack is optional
+    msgpack = None
+
+PICKLE_PROTOCOL = min(5, pickle.HIGHEST_PROTOCOL)
+
+
+def pickle_dumps(value):
+    return pickle.dumps(value, protocol=PICKLE_PROTOCOL)
+
+
+def _key_default(value):
+    if isinstance(value, (set, frozenset)):
+        # sorted by their encoding, so the order does not depend on PYTHONHASHSEED
+        return {'__set__': sorted(key_dumps(item) for item in value)}
+    if isinstance(value, (bytes, bytearray)):
+        return {'__bytes__': value.hex()}
+    raise TypeError(f'Object of type {type(value).__name__} cannot be part of a key')
+
+
+def key_dumps(value):
+    """
+    Canonical JSON encoding of the arguments of a call - the key serializer of the binary presets. Unlike pickle, it
+    does not depend on object identity or PYTHONHASHSEED, so equal arguments make the same key in every process.
+    Sets and bytes are supported on top of JSON types
+    """
+    return json.dumps(value, sort_keys=True, separators=(',', ':'), default=_key_default)
+
+
+def msgpack_dumps(value):
+    return msgpack.packb(value, use_bin_type=True)
+
+
+def msgpack_loads(data):
+    return msgpack.unpackb(data, raw=False)
+
+
+# name: (serializer, deserializer, binary)
+PRESETS = {
+    'json': (json.dumps, json.loads, False),
+    'pickle': (pickle_dumps, pickle.loads, True),
+}
+if msgpack is not None:
+    PRESETS['msgpack'] = (msgpack_dumps, msgpack_loads, True)
+
+
+def serialization_options(name):
+    """
+    Returns the cache options of a serialization preset - json, pickle (protocol 5) or msgpack (if installed).
+    Binary presets also select key_strategy='hash', so keys are digests of the serialized arguments, rather than
+    base64 encoded serialized arguments - the arguments are serialized by key_dumps, as binary formats are not
+    canonical.
+    """
+    if name not in PRESETS:
+        raise ValueError('Unsupported serialization: {} (msgpack requires the msgpack package)'.format(name))
+    serializer, deserializer, binary = PRESETS[name]
+    options = {'serializer': serializer, 'deserializer': deserializer}
+    if binary:
+        options.update(key_strategy='hash', key_serializer=key_dumps)
+    return options
+
+
+def is_binary(serializer):
+    """
+    Returns True if serializer is the serializer of a binary preset
+    """
+    return any(binary and preset is serializer for preset, _, binary in PRESETS.values())
@@ -0,0 +1,84 @@
+import asyncio
+from threading import Event, Lock
+
+
+class _Call(object):
+    def __init__(self):
+        self.done = Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight(object):
+    """
+    Coalesces concurrent calls for the same key, so only one caller (the leader) executes the function
+    while the others wait for - and share - its result.
+    If the leader raises, the waiting callers receive the same exception.
+    Callers waiting longer than timeout seconds give up and execute the function themselves.
+    """
+    def __init__(self, timeout=10):
+        self.timeout = timeout
+        self.lock = Lock()
+        self.calls = {}
+
+    def do(self, key, fn, *args, **kwargs):
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.calls[key] = _Call()
+        if not leader:
+            if not call.done.wait(self.timeout):
+                return fn(*args, **kwargs)
+            if call.error is not None:
+                raise call.error
+            return call.result
+        try:
+            call.result = fn(*args, **kwargs)
+            return call.result
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+            call.done.set()
+
+
+class AsyncSingleFlight(object):
+    """
+    asyncio version of SingleFlight - coalesces concurrent tasks awaiting the same key (within an event loop),
+    so only one task awaits the coroutine function while the others wait for - and share - its result.
+    If the leading task is cancelled, the waiting tasks await the coroutine function themselves.
+    """
+    def __init__(self, timeout=10):
+        self.timeout = timeout
+        self.calls = {}
+
+    async def do(self, key, fn, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        call_key = (loop, key)
+        future = self.calls.get(call_key)
+        if future is not None:
+            try:
+                return await asyncio.wait_for(asyncio.shield(future), self.timeout)
+            except asyncio.TimeoutError:
+                return await fn(*args, **kwargs)
+            except asyncio.CancelledError:
+                if not future.cancelled():
+                    raise  # this task was cancelled - not the leader
+                return await fn(*args, **kwargs)
+        future = self.calls[call_key] = loop.create_future()
+        try:
+            result = await fn(*args, **kwargs)
+            future.set_result(result)
+            return result
+        except Exception as e:
+            future.set_exception(e)
+            future.exception()  # mark as retrieved, in case no tasks are waiting
+            raise
+        except BaseException:
+            future.cancel()
+            raise
+        finally:
+            del self.calls[call_key]
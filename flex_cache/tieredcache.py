@@ -0,0 +1,137 @@
+from json import dumps, loads
+from .basecache import BaseCache, BaseCacheDecorator, MISS
+from .memcache import MemCacheDecorator
+from .rediscache import RedisCache, check_binary_client
+
+
+class TieredCache(BaseCache):
+    """
+    Composite cache, layering caches (tiers) from fastest to slowest - typically a bounded MemCache (L1) over a
+    RedisCache (L2), optionally with a DiskCache in between.
+    Values are read from the first tier holding them (and promoted to the faster tiers, if promote is True), and
+    written to all tiers. Invalidations are applied to all tiers, and broadcast over redis pub/sub (if a tier is a
+    RedisCache), so the local tiers of other processes drop their copies too.
+    """
+    def __init__(self, *tiers, l1_ttl=60, promote=True, channel=None, prefix="rc", serializer=dumps,
+                 deserializer=loads, **options):
+        """
+        Args:
+            *tiers: the caches - fastest first
+            l1_ttl: max ttl (in seconds) of values in the first tier - 0 means the ttl of the decorator
+            promote: if True, values found in a slower tier are written to the faster tiers
+            channel: the redis pub/sub channel for invalidations - defaults to f'{prefix}:invalidate'
+        """
+        if len(tiers) < 2:
+            raise ValueError('TieredCache needs at least 2 tiers')
+        redis_tiers = [tier for tier in tiers if isinstance(tier, RedisCache)]
+        self.channel = (channel or f'{prefix}:invalidate') if redis_tiers else None
+        super().__init__(TieredCacheDecorator, tiers, prefix, serializer, deserializer, l1_ttl=l1_ttl,
+                         promote=promote, channel=self.channel, **options)
+        self.subscriber = None
+        self.redis = redis_tiers[0]._cache if redis_tiers else None
+        if redis_tiers:
+            pubsub = redis_tiers[0]._cache.pubsub(ignore_subscribe_messages=True)
+            pubsub.subscribe(**{self.channel: self._on_invalidate})
+            self.subscriber = pubsub.run_in_thread(sleep_time=0.01, daemon=True)
+
+    def _on_invalidate(self, message):
+        """
+        Drops an invalidated key - or namespace, if the key is None, or tagged keys - from the local tiers
+        """
+        namespace, key, tags = loads(message['data'])
+        for tier in self._cache:
+            if isinstance(tier, RedisCache):
+                continue
+            if tags:
+                tier._invalidate_tags(tags)
+            elif key is None:
+                tier.cache(namespace=namespace).invalidate_all()
+            else:
+                tier.cache(namespace=namespace).invalidate_key(key)
+
+    def _invalidate_tags(self, tags):
+        for tier in self._cache:
+            tier._invalidate_tags(tags)
+        if self.channel:
+            self.redis.publish(self.channel, dumps([None, None, tags]))
+
+    def close(self):
+        if self.subscriber:
+            self.subscriber.stop()
+            self.subscriber = None
+
+
+class TieredCacheDecorator(BaseCacheDecorator):
+    def __init__(self, tiers, prefix='rc', serializer=dumps, deserializer=loads, ttl=0, limit=0, namespace=None,
+                 l1_ttl=60, promote=True, channel=None, **kwargs):
+        self.tiers = []
+        for i, tier in enumerate(tiers):
+            tier_ttl = ttl
+            if i == 0 and l1_ttl:
+                tier_ttl = min(ttl, l1_ttl) if ttl else l1_ttl
+            # MemCache does not support limits
+            tier_limit = 0 if tier._decorator is MemCacheDecorator else limit
+            self.tiers.append(tier._decorator(tier._cache, prefix, serializer, deserializer, tier_ttl, tier_limit,
+                                              namespace))
+        self.l1_ttl = l1_ttl
+        self.promote = promote
+        self.channel = channel
+        self.redis = next((tier._cache for tier in tiers if isinstance(tier, RedisCache)), None)
+        super().__init__(tiers, prefix, serializer, deserializer, ttl, limit, namespace, **kwargs)
+        if self.stale_ttl or self.early_recompute:
+            # the remaining ttl of L1 copies is capped by l1_ttl, so it does not tell whether a value is stale
+            raise ValueError('TieredCache does not support stale_ttl or early_recompute')
+        if self.codec and self.redis is not None:
+            check_binary_client(self.redis)
+
+    @property
+    def keys_key(self):
+        return self.tiers[0].keys_key
+
+    @keys_key.setter
+    def keys_key(self, keys_key):
+        for tier in self.tiers:
+            tier.keys_key = keys_key
+
+    def _bind_function(self, fn):
+        super()._bind_function(fn)
+        for tier in self.tiers:
+            tier._bind_function(fn)
+
+    def check_cache(self, key):
+        for i, tier in enumerate(self.tiers):
+            result = tier.check_cache(key)
+            if result is not MISS:
+                if self.promote:
+                    for faster in self.tiers[:i]:
+                        faster.cache_output(key, result)
+                return result
+        return MISS
+
+    def cache_output(self, key, serialized, ttl=None):
+        for i, tier in reversed(list(enumerate(self.tiers))):
+            tier_ttl = ttl
+            if i == 0 and ttl and self.l1_ttl:
+                tier_ttl = min(ttl, self.l1_ttl)
+            tier.cache_output(key, serialized, tier_ttl)
+
+    def tag_key(self, key, tags, ttl=None):
+        for tier in self.tiers:
+            tier.tag_key(key, tags, ttl)
+
+    def invalidate_key(self, key):
+        for tier in self.tiers:
+            tier.invalidate_key(key)
+        self._broadcast(key)
+
+    def invalidate(self, *args, **kwargs):
+        self.invalidate_key(self.get_key(args, kwargs))
+
+    def invalidate_all(self, *args, **kwargs):
+        for tier in self.tiers:
+            tier.invalidate_all()
+        self._broadcast()
+
+    def _broadcast(self, key=None):
+        if self.channel:
+            self.redis.publish(self.channel, dumps([self.namespace, key, None]))
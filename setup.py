@@ -14,8 +14,8 @@ setup(name='python-flex-cache',
       url='http://github.com/steffenschumacher/python-flex-cache',
       author='Steffen Schumacher (forked from python-redis-cache // Taylor Hakes)',
       license='MIT',
-      python_requires='>=3.6',
+      python_requires='>=3.7',
       packages=find_packages(),
       setup_requires=['pytest-runner==5.2', 'diskcache==5.2.1'],
-      tests_require=['pytest==5.4.3', 'redis==3.5.3'],
+      tests_require=['pytest==5.4.3', 'redis>=5.0.1'],
 )
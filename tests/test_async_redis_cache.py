@@ -0,0 +1,329 @@
+import asyncio
+import uuid
+
+from redis.asyncio import StrictRedis
+from flex_cache import AsyncRedisCache
+
+import pytest
+
+
+redis_host = "redis-test-host"
+
+
+def run(coroutine_function):
+    """ Runs the coroutine function with a fresh client (bound to the event loop of the test) """
+    async def with_client():
+        client = StrictRedis(host=redis_host, decode_responses=True)
+        try:
+            return await coroutine_function(AsyncRedisCache(redis_client=client))
+        finally:
+            await client.aclose()
+    return asyncio.run(with_client())
+
+
+async def add_func(n1, n2):
+    """ Add function
+    Add n1 to n2 and return a uuid4 unique verifier
+
+    Returns:
+        tuple(int, str(uuid.uuid4))
+    """
+    await asyncio.sleep(0)
+    return n1 + n2, str(uuid.uuid4())
+
+
+def test_basic_check():
+    async def check(cache):
+        @cache.cache()
+        async def add_basic(arg1, arg2):
+            return await add_func(arg1, arg2)
+
+        r_3_4, v_3_4 = await add_basic(3, 4)
+        r_3_4_cached, v_3_4_cached = await add_basic(3, 4)
+        r_5_5, v_5_5 = await add_basic(5, 5)
+
+        assert 7 == r_3_4 == r_3_4_cached and v_3_4 == v_3_4_cached
+        assert 10 == r_5_5 and v_5_5 != r_3_4
+    run(check)
+
+
+def test_sync_function():
+    async def check(cache):
+        with pytest.raises(ValueError):
+            @cache.cache()
+            def add_sync(arg1, arg2):
+                pass
+    run(check)
+
+
+def test_invalidate():
+    async def check(cache):
+        @cache.cache()
+        async def add_invalidate(arg1, arg2):
+            return await add_func(arg1, arg2)
+
+        @cache.cache()
+        async def f2222_invalidate_all(arg1, arg2):
+            return await add_func(arg1, arg2)
+
+        r_3_4, v_3_4 = await add_invalidate(3, 4)
+        r_4_4, v_4_4 = await add_invalidate(4, 4)
+        r_5_5, v_5_5 = await f2222_invalidate_all(5, 5)
+        await add_invalidate.invalidate(4, 4)
+        assert v_3_4 == (await add_invalidate(3, 4))[1]
+        assert v_4_4 != (await add_invalidate(4, 4))[1]
+        await add_invalidate.invalidate_all()
+        assert not await cache._cache.exists(add_invalidate.instance.keys_key)
+        assert v_3_4 != (await add_invalidate(3, 4))[1]
+        assert v_5_5 == (await f2222_invalidate_all(5, 5))[1]
+    run(check)
+
+
+def test_single_flight():
+    async def check(cache):
+        calls = []
+
+        @cache.cache(single_flight=True)
+        async def add_single_flight(arg1, arg2):
+            calls.append(1)
+            await asyncio.sleep(0.2)
+            return await add_func(arg1, arg2)
+
+        results = await asyncio.gather(*[add_single_flight(3, 4) for _ in range(8)])
+        assert len(calls) == 1
+        assert all(r == results[0] for r in results)
+    run(check)
+
+
+def test_lease():
+    async def check(cache):
+        calls = []
+
+        async def add_lease(arg1, arg2):
+            calls.append(1)
+            await asyncio.sleep(0.2)
+            return await add_func(arg1, arg2)
+
+        # separate decorators - like separate worker processes sharing the same redis
+        workers = [cache.cache(lease_ttl=5, namespace='async_lease')(add_lease) for _ in range(4)]
+        results = await asyncio.gather(*[worker(3, 4) for worker in workers])
+        assert len(calls) == 1
+        assert all(list(r) == list(results[0]) for r in results)
+    run(check)
+
+
+def test_negative_ttl():
+    async def check(cache):
+        calls = []
+
+        @cache.cache(negative_ttl=1, negative_exceptions=(KeyError,))
+        async def lookup(arg1):
+            calls.append(1)
+            raise KeyError(arg1)
+
+        for _ in range(2):
+            with pytest.raises(KeyError):
+                await lookup('missing')
+        assert len(calls) == 1
+    run(check)
+
+
+def test_basic_mget():
+    async def check(cache):
+        @cache.cache()
+        async def add_basic_get(arg1, arg2):
+            return await add_func(arg1, arg2)
+
+        r_3_4, v_3_4 = (await cache.mget({"fn": add_basic_get, "args": (3, 4)}))[0]
+        r2_3_4, v2_3_4 = await add_basic_get(3, 4)
+
+        assert r_3_4 == r2_3_4 and v_3_4 == v2_3_4
+    run(check)
+
+
+def test_mget_max_concurrency():
+    async def check(cache):
+        running = []
+        peak = []
+
+        @cache.cache()
+        async def slow_add(arg1, arg2):
+            running.append(arg1)
+            peak.append(len(running))
+            await asyncio.sleep(0.02)
+            running.remove(arg1)
+            return arg1 + arg2
+
+        results = await cache.mget(*[{"fn": slow_add, "args": (n, n)} for n in range(10)], max_concurrency=3)
+        assert results == [n + n for n in range(10)]
+        assert max(peak) == 3
+        assert await cache.mget({"fn": slow_add, "args": (4, 4)}) == [8]
+    run(check)
+
+
+def test_basecache_setget():
+    async def check(cache):
+        await cache.set('setget', 'basic', namespace='async_base')
+        assert 'basic' == await cache.get('setget', namespace='async_base')
+        await cache.invalidate('setget', namespace='async_base')
+        assert await cache.get('setget', namespace='async_base') is None
+    run(check)
+
+
+def test_basecache_many():
+    async def check(cache):
+        await cache.set_many({'a': 1, 'b': [2]}, namespace='async_many')
+        await cache.set_many(((f'k{i}', i) for i in range(1500)), ttl=3600, namespace='async_many')
+        assert await cache.get_many(['a', 'b', 'missing', 'k1499'], namespace='async_many', default='-') == \
+            [1, [2], '-', 1499]
+        await cache.delete_many((f'k{i}' for i in range(0, 1500, 2)), namespace='async_many', chunk_size=100)
+        assert await cache.get_many(['k0', 'k1', 'k2'], namespace='async_many') == [None, 1, None]
+    run(check)
+
+
+def test_invalidate_all_set_namespace():
+    async def check(cache):
+        await cache.set('a', 1, namespace='async_set_only')
+        await cache.set_many({'b': 2, 'c': 3}, ttl=60, namespace='async_set_only')
+        await cache.cache(namespace='async_set_only').invalidate_all()
+        assert await cache.get_many(['a', 'b', 'c'], namespace='async_set_only', default='-') == ['-', '-', '-']
+    run(check)
+
+
+def test_limit_lru():
+    async def check(cache):
+        @cache.cache(limit=2, eviction_policy='lru')
+        async def add_limit_lru(arg1, arg2):
+            return await add_func(arg1, arg2)
+
+        r_3_4, v_3_4 = await add_limit_lru(3, 4)
+        r_5_5, v_5_5 = await add_limit_lru(5, 5)
+        assert (await cache.mget({"fn": add_limit_lru, "args": (3, 4)}))[0][1] == v_3_4
+        await add_limit_lru(6, 5)  # evicts (5, 5), the least recently used
+
+        assert (await add_limit_lru(3, 4))[1] == v_3_4
+        assert (await add_limit_lru(5, 5))[1] != v_5_5
+    run(check)
+
+
+def test_tags():
+    async def check(cache):
+        @cache.cache(tags=lambda customer, item: [f'customer:{customer}'])
+        async def get_order(customer, item):
+            return await add_func(customer, item)
+
+        o1, o2 = await get_order(1, 10), await get_order(2, 10)
+        o3 = (await cache.mget({"fn": get_order, "args": (3, 10)}))[0]
+        await cache.invalidate_tags('customer:1', 'customer:3')
+        assert (await get_order(1, 10))[1] != o1[1]
+        assert (await get_order(2, 10))[1] == o2[1]
+        assert (await get_order(3, 10))[1] != o3[1]
+    run(check)
+
+
+def test_stale_while_revalidate():
+    async def check(cache):
+        calls = []
+
+        @cache.cache(ttl=1, stale_ttl=5)
+        async def add_stale(arg1, arg2):
+            calls.append(1)
+            await asyncio.sleep(0.1)
+            return await add_func(arg1, arg2)
+
+        v = list(await add_stale(1, 2))
+        await asyncio.sleep(1.1)
+        stale = await asyncio.gather(*[add_stale(1, 2) for _ in range(4)])
+        await asyncio.sleep(0.2)
+        assert all(s == v for s in stale)
+        assert await add_stale(1, 2) != v
+        assert len(calls) == 2
+        await add_stale.invalidate(1, 2)
+
+    run(check)
+
+
+def test_early_recompute(monkeypatch):
+    import flex_cache.basecache
+    monkeypatch.setattr(flex_cache.basecache, 'random', lambda: 0.5)
+
+    async def check(cache):
+        @cache.cache(ttl=4, early_recompute=60)
+        async def add_early(arg1, arg2):
+            await asyncio.sleep(0.05)
+            return await add_func(arg1, arg2)
+
+        v = list(await add_early(1, 2))
+        assert await add_early(1, 2) == v
+        await asyncio.sleep(2.2)
+        assert await add_early(1, 2) == v
+        await asyncio.sleep(0.2)
+        assert await add_early(1, 2) != v
+        await add_early.invalidate(1, 2)
+
+    run(check)
+
+
+def test_metrics():
+    async def check(cache):
+        @cache.cache(metrics=True)
+        async def add_metered(arg1, arg2):
+            return await add_func(arg1, arg2)
+
+        await add_metered.invalidate(1, 2)
+        await add_metered(1, 2)
+        await add_metered(1, 2)
+        info = add_metered.cache_info()
+        assert (info.hits, info.misses, info.sets, info.read.count, info.write.count) == (1, 1, 1, 2, 1)
+        assert cache.metrics.snapshot()[add_metered.instance.namespace] == info
+
+    run(check)
+
+
+def test_profiler():
+    async def check(cache):
+        profiles = []
+
+        @cache.cache(profiler=profiles.append)
+        async def add_profiled(arg1, arg2):
+            return await add_func(arg1, arg2)
+
+        await add_profiled.invalidate(1, 2)
+        await add_profiled(1, 2)
+        await add_profiled(1, 2)
+        miss, hit = profiles
+        assert [p.name for p in miss.phases] == ['filter_args', 'key', 'backend_read', 'compute', 'serialize',
+                                                 'backend_write']
+        assert [p.name for p in hit.phases] == ['filter_args', 'key', 'backend_read', 'deserialize']
+        assert hit.phases[2].size == miss.phases[5].size > 0
+
+    run(check)
+
+
+def test_fractional_ttls():
+    async def check(cache):
+        @cache.cache(ttl=0.5)
+        async def add_fractional(arg1, arg2):
+            return await add_func(arg1, arg2)
+
+        v = list(await add_fractional(1, 2))
+        assert await add_fractional(1, 2) == v
+        assert 0 < await cache._cache.pttl(add_fractional.instance.get_key((1, 2), {})) <= 500
+
+    run(check)
+
+
+def test_mget_jitter_tags():
+    async def check(cache):
+        @cache.cache(ttl=60.0, ttl_jitter=0.5, tags=lambda arg1, arg2: f'jitter{arg1}')
+        async def add_jitter(arg1, arg2):
+            return await add_func(arg1, arg2)
+
+        await cache.mget(*[{"fn": add_jitter, "args": (i, i)} for i in range(10)])
+        for i in range(10):
+            key_ttl = await cache._cache.pttl(add_jitter.instance.get_key((i, i), {}))
+            tag_ttl = await cache._cache.pttl(f'rc:tag:jitter{i}')
+            assert 30000 <= key_ttl <= 60000
+            assert abs(key_ttl - tag_ttl) < 1000
+
+    run(check)
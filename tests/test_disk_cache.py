@@ -1,5 +1,6 @@
 import uuid
 import time
+from concurrent.futures import ThreadPoolExecutor
 
 from flex_cache import DiskCache
 from diskcache import Cache as DCache
@@ -60,13 +61,53 @@ def test_ttl(cache):
 
 
 def test_limit(cache):
-    try:
-        @cache.cache(limit=2)
-        def add_limit(arg1, arg2):
-            return add_func(arg1, arg2)
-        pytest.fail('Limit is not supported with diskcache')
-    except ValueError as ve:
-        pass
+    @cache.cache(limit=2)
+    def add_limit(arg1, arg2):
+        return add_func(arg1, arg2)
+
+    r_3_4, v_3_4 = add_limit(3, 4)
+    r_5_5, v_5_5 = add_limit(5, 5)
+    r_6_5, v_6_5 = add_limit(6, 5)  # limit hit - (3, 4) is evicted
+
+    r2_3_4, v2_3_4 = add_limit(3, 4)  # new cache generated - (5, 5) is evicted
+    assert r_3_4 == r2_3_4 and v_3_4 != v2_3_4
+
+    r2_6_5, v2_6_5 = add_limit(6, 5)  # still cached
+    assert r_6_5 == r2_6_5 and v_6_5 == v2_6_5
+    assert len(add_limit.instance.cache) == 2
+
+
+def test_limit_lru(cache):
+    @cache.cache(limit=2, eviction_policy='lru')
+    def add_limit_lru(arg1, arg2):
+        return add_func(arg1, arg2)
+
+    r_3_4, v_3_4 = add_limit_lru(3, 4)
+    r_5_5, v_5_5 = add_limit_lru(5, 5)
+    time.sleep(0.01)
+    add_limit_lru(3, 4)  # (3, 4) is now the most recently used
+    add_limit_lru(6, 5)  # limit hit - (5, 5) is evicted
+
+    r2_3_4, v2_3_4 = add_limit_lru(3, 4)
+    r2_5_5, v2_5_5 = add_limit_lru(5, 5)
+    assert v_3_4 == v2_3_4 and v_5_5 != v2_5_5
+
+
+def test_size_limit(cache):
+    @cache.cache(size_limit=2 ** 16)
+    def big(arg1):
+        return 'x' * 2 ** 12 + str(arg1)
+
+    for i in range(100):
+        big(i)
+    cache.set('setget', 'basic', namespace=big.instance.namespace)
+    assert big.instance.cache.volume() < 2 ** 17
+    assert cache.get('setget', namespace=big.instance.namespace) == 'basic'
+
+
+def test_unsupported_eviction_policy(cache):
+    with pytest.raises(ValueError):
+        cache.cache(limit=2, eviction_policy='random')
 
 
 def test_invalidate_not_in_cache(cache):
@@ -192,6 +233,26 @@ def test_basic_mget(cache):
     assert r_3_4 == r2_3_4 and v_3_4 == v2_3_4
 
 
+def test_mget_positional(cache):
+    calls = []
+
+    @cache.cache()
+    def add_mget(arg1, arg2):
+        calls.append((arg1, arg2))
+        return arg1 + arg2
+
+    add_mget(3, 4)
+    results = cache.mget({"fn": add_mget, "args": (5, 6)},
+                         {"fn": add_mget, "args": (3, 4)},
+                         {"fn": add_mget, "kwargs": {"arg1": 1, "arg2": 1}})
+    assert results == [11, 7, 2]
+    assert calls == [(3, 4), (5, 6), (1, 1)]
+    # the misses were cached
+    assert cache.mget({"fn": add_mget, "args": (5, 6)}, {"fn": add_mget, "kwargs": {"arg1": 1, "arg2": 1}}) == [11, 2]
+    assert add_mget(5, 6) == 11
+    assert len(calls) == 3
+
+
 def test_basecache_setget(cache):
     cache.set('setget', 'basic', namespace='base')
     assert 'basic' == cache.get('setget', namespace='base')
@@ -208,3 +269,237 @@ def test_basecache_invalidate(cache):
     cache.invalidate('setget', namespace='base')
     assert cache.get('setget', namespace='base') is None
 
+def test_basecache_many(cache):
+    cache.set_many({'a': 1, 'b': [2]}, namespace='many')
+    cache.set_many(((f'k{i}', i) for i in range(2500)), ttl=3600, namespace='many', chunk_size=1000)
+    assert cache.get_many(['a', 'b', 'missing', 'k2499'], namespace='many', default='-') == [1, [2], '-', 2499]
+    assert cache.get_many((f'k{i}' for i in range(2500)), namespace='many') == list(range(2500))
+    cache.delete_many((f'k{i}' for i in range(0, 2500, 2)), namespace='many', chunk_size=100)
+    assert cache.get_many(['k0', 'k1', 'k2', 'k3'], namespace='many') == [None, 1, None, 3]
+    assert cache.get('k1', namespace='many') == 1
+
+
+
+
+def test_single_flight(cache):
+    from concurrent.futures import ThreadPoolExecutor
+    calls = []
+
+    @cache.cache(single_flight=True)
+    def add_single_flight(arg1, arg2):
+        calls.append(1)
+        time.sleep(0.5)
+        return add_func(arg1, arg2)
+
+    with ThreadPoolExecutor(8) as tp:
+        results = list(tp.map(lambda _: add_single_flight(3, 4), range(8)))
+
+    assert len(calls) == 1
+    assert all(r == results[0] for r in results)
+
+
+def test_falsy_results(cache):
+    calls = []
+
+    @cache.cache()
+    def falsy(arg1):
+        calls.append(1)
+        return [0, '', [], None][arg1]
+
+    for i in range(4):
+        assert falsy(i) == falsy(i)
+    assert len(calls) == 4
+
+
+def test_negative_ttl(cache):
+    calls = []
+
+    @cache.cache(negative_ttl=1, negative_exceptions=(KeyError,))
+    def lookup(arg1):
+        calls.append(1)
+        if arg1 == 'missing':
+            raise KeyError(arg1)
+        return None
+
+    assert lookup('none') is None
+    assert lookup('none') is None
+    for _ in range(2):
+        with pytest.raises(KeyError) as ke:
+            lookup('missing')
+        assert ke.value.args == ('missing',)
+    assert len(calls) == 2
+    time.sleep(2)
+    assert lookup('none') is None
+    with pytest.raises(KeyError):
+        lookup('missing')
+    assert len(calls) == 4
+
+
+def test_basecache_get_default(cache):
+    cache.set('setget_none', None, namespace='base')
+    assert cache.get('setget_none', namespace='base', default='x') is None
+    assert cache.get('setget_missing', namespace='base', default='x') == 'x'
+
+
+def test_hashed_keys(cache):
+    @cache.cache(key_strategy='hash', key_debug=True)
+    def add_hashed(arg1, filters):
+        return add_func(arg1, len(filters))
+
+    filters = {f'filter{i}': 'x' * 100 for i in range(100)}
+    r_1, v_1 = add_hashed(1, filters)
+    r_2, v_2 = add_hashed(1, filters)
+    assert r_1 == r_2 == 101 and v_1 == v_2
+    key = add_hashed.instance.get_key((1, filters), {})
+    assert len(key) == len(f'rc:{add_hashed.instance.namespace}:') + 32
+    assert 'filter99' in add_hashed.instance.key_args[key]
+    add_hashed.invalidate(1, filters)
+    assert v_1 != add_hashed(1, filters)[1]
+
+
+def test_normalize_args(cache):
+    calls = []
+
+    @cache.cache(normalize_args=True)
+    def add_normalized(arg1, arg2=2, *args, kwarg1=None, **kwargs):
+        calls.append(1)
+        return add_func(arg1, arg2)
+
+    v = add_normalized(1)[1]
+    assert v == add_normalized(1, 2)[1] == add_normalized(1, arg2=2)[1] == add_normalized(arg2=2, arg1=1)[1]
+    assert v == add_normalized(1, kwarg1=None)[1]
+    assert len(calls) == 1
+    add_normalized(1, 2, 3)
+    add_normalized(1, 2, x=1, y=2)
+    add_normalized(1, 2, y=2, x=1)
+    assert len(calls) == 3
+    add_normalized.invalidate(arg1=1)
+    assert v != add_normalized(1, 2)[1]
+    with pytest.raises(TypeError):
+        add_normalized(arg2=2)
+
+
+def test_tags(cache):
+    @cache.cache(tags=lambda customer, item: [f'customer:{customer}'])
+    def get_order(customer, item):
+        return add_func(customer, item)
+
+    @cache.cache(tags='catalog', namespace='tags_catalog')
+    def get_price(item):
+        return add_func(item, 0)
+
+    @cache.cache(tags=lambda customer: ['catalog', f'customer:{customer}'])
+    def get_profile(customer):
+        return add_func(customer, 1)
+
+    o1, o2, price, profile = get_order(1, 10), get_order(2, 10), get_price(10), get_profile(1)
+    cache.invalidate_tags('customer:1')
+    assert get_order(1, 10)[1] != o1[1]
+    assert get_order(2, 10)[1] == o2[1]
+    assert get_price(10)[1] == price[1]
+    assert get_profile(1)[1] != profile[1]
+
+    profile = get_profile(1)
+    cache.invalidate_tags('catalog', 'unknown')
+    assert get_price(10)[1] != price[1]
+    assert get_profile(1)[1] != profile[1]
+    assert get_order(2, 10)[1] == o2[1]
+
+    # values computed by mget are tagged too
+    o3 = cache.mget({"fn": get_order, "args": (3, 10)})[0]
+    assert get_order(3, 10)[1] == o3[1]
+    cache.invalidate_tags('customer:3')
+    assert get_order(3, 10)[1] != o3[1]
+
+
+def test_tags_limited_namespace(cache):
+    @cache.cache(limit=10, tags=lambda arg1, arg2: [f'arg1:{arg1}'], namespace='tags_limited')
+    def add_tags_limited(arg1, arg2):
+        return add_func(arg1, arg2)
+
+    r1, r2 = add_tags_limited(1, 1), add_tags_limited(2, 1)
+    # the tag index entries are stored in the root cache, so they do not count towards the limit
+    assert len(add_tags_limited.instance.cache) == 2
+    cache.invalidate_tags('arg1:1')
+    assert add_tags_limited(1, 1)[1] != r1[1]
+    assert add_tags_limited(2, 1)[1] == r2[1]
+
+
+def test_invalidate_all_exact_namespace(cache):
+    @cache.cache(namespace='exact')
+    def add_exact(arg1, arg2):
+        return add_func(arg1, arg2)
+
+    @cache.cache(namespace='exact_too')
+    def add_exact_too(arg1, arg2):
+        return add_func(arg1, arg2)
+
+    r1, r2 = add_exact(1, 1), add_exact_too(1, 1)
+    cache.set('direct', 1, namespace='exact')
+    add_exact.invalidate_all()
+    assert add_exact(1, 1)[1] != r1[1]
+    assert cache.get('direct', namespace='exact') is None
+    # namespaces merely containing the namespace are not invalidated
+    assert add_exact_too(1, 1)[1] == r2[1]
+
+
+def test_codec():
+    cache = DiskCache(dc, codec='lzma', codec_min_size=100)
+
+    @cache.cache(namespace='codec')
+    def doc_codec(n):
+        return {'items': ['x' * 10] * n}
+
+    large = doc_codec(1000)
+    assert doc_codec(1000) == large
+    assert len(dc.get(doc_codec.instance.get_key((1000,), {}))) < 1000
+
+
+def test_stale_while_revalidate(cache):
+    calls = []
+    executor = ThreadPoolExecutor(max_workers=4)
+
+    @cache.cache(ttl=0.2, stale_ttl=5, refresh_executor=executor)
+    def add_stale(arg1, arg2):
+        calls.append(1)
+        return add_func(arg1, arg2)
+
+    v = list(add_stale(1, 2))
+    time.sleep(0.3)
+    assert add_stale(1, 2) == v  # stale
+    executor.shutdown(wait=True)
+    assert len(calls) == 2
+    assert add_stale(1, 2) != v
+
+
+def test_early_recompute(cache, monkeypatch):
+    import flex_cache.basecache
+    monkeypatch.setattr(flex_cache.basecache, 'random', lambda: 0.5)
+    executor = ThreadPoolExecutor(max_workers=4)
+
+    @cache.cache(ttl=1, early_recompute=10, ttl_jitter=0.1, refresh_executor=executor)
+    def add_early(arg1, arg2):
+        time.sleep(0.05)
+        return add_func(arg1, arg2)
+
+    v = list(add_early(1, 2))
+    assert add_early(1, 2) == v
+    time.sleep(0.75)
+    assert add_early(1, 2) == v
+    executor.shutdown(wait=True)
+    assert add_early(1, 2) != v
+
+
+def test_metrics_evictions():
+    cache = DiskCache(dc, metrics=True)
+
+    @cache.cache(limit=2)
+    def add_metered_limit(arg1, arg2):
+        return add_func(arg1, arg2)
+
+    add_metered_limit.invalidate_all()
+    for i in range(5):
+        add_metered_limit(i, i)
+    info = add_metered_limit.cache_info()
+    assert (info.misses, info.sets, info.evictions) == (5, 5, 3)
+    assert cache.set('metered_set', 1, limit=2) is None
@@ -1,5 +1,12 @@
+import asyncio
+import gc
+import os
+import subprocess
+import sys
+import threading
 import uuid
 import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
 from flex_cache import MemCache
 
@@ -18,6 +25,14 @@ def cache():
     return MemCache()
 
 
+module_cache = MemCache()
+
+
+@module_cache.cache()
+def pid_square(n):
+    return n * n, os.getpid()
+
+
 def add_func(n1, n2):
     """ Add function
     Add n1 to n2 and return a uuid4 unique verifier
@@ -223,6 +238,83 @@ def test_basic_mget(cache):
     assert r_3_4 == r2_3_4 and v_3_4 == v2_3_4
 
 
+def test_mget_positional(cache):
+    calls = []
+
+    @cache.cache()
+    def add_mget(arg1, arg2):
+        calls.append((arg1, arg2))
+        return arg1 + arg2
+
+    add_mget(3, 4)
+    results = cache.mget({"fn": add_mget, "args": (5, 6)},
+                         {"fn": add_mget, "args": (3, 4)},
+                         {"fn": add_mget, "kwargs": {"arg1": 1, "arg2": 1}})
+    assert results == [11, 7, 2]
+    assert calls == [(3, 4), (5, 6), (1, 1)]
+    # the misses were cached
+    assert cache.mget({"fn": add_mget, "args": (5, 6)}, {"fn": add_mget, "kwargs": {"arg1": 1, "arg2": 1}}) == [11, 2]
+    assert add_mget(5, 6) == 11
+    assert len(calls) == 3
+
+
+def test_mget_thread_executor(cache):
+    running = []
+    peak = []
+    lock = threading.Lock()
+
+    @cache.cache()
+    def slow_square(n):
+        with lock:
+            running.append(n)
+            peak.append(len(running))
+        time.sleep(0.05)
+        with lock:
+            running.remove(n)
+        return n * n
+
+    start = time.time()
+    with ThreadPoolExecutor(max_workers=20) as executor:
+        results = cache.mget(*[{"fn": slow_square, "args": (n,)} for n in range(20)], executor=executor,
+                             max_concurrency=5)
+    assert results == [n * n for n in range(20)]
+    assert max(peak) <= 5
+    assert time.time() - start < 0.05 * 20 / 2
+    # the results were cached
+    assert cache.mget(*[{"fn": slow_square, "args": (n,)} for n in range(20)]) == results
+    assert len(peak) == 20
+
+
+def test_mget_process_executor():
+    with ProcessPoolExecutor(max_workers=2) as executor:
+        results = module_cache.mget(*[{"fn": pid_square, "args": (n,)} for n in range(4)], executor=executor)
+    assert [r[0] for r in results] == [0, 1, 4, 9]
+    assert os.getpid() not in [r[1] for r in results]
+    assert pid_square(3) == list(results[3])
+
+
+def test_mget_asyncio_loop(cache):
+    @cache.cache()
+    async def async_square(n):
+        await asyncio.sleep(0.05)
+        return n * n
+
+    @cache.cache()
+    def sync_square(n):
+        return n * n
+
+    loop = asyncio.new_event_loop()
+    try:
+        start = time.time()
+        results = cache.mget(*[{"fn": async_square, "args": (n,)} for n in range(20)],
+                             {"fn": sync_square, "args": (5,)}, executor=loop)
+        assert time.time() - start < 0.05 * 20 / 2
+    finally:
+        loop.close()
+    assert results == [n * n for n in range(20)] + [25]
+    assert cache.mget({"fn": sync_square, "args": (5,)}) == [25]
+
+
 def test_basecache_setget(cache):
     cache.set('setget', 'basic', namespace='base')
     assert 'basic' == cache.get('setget', namespace='base')
@@ -239,6 +331,37 @@ def test_basecache_invalidate(cache):
     cache.invalidate('setget', namespace='base')
     assert cache.get('setget', namespace='base') is None
 
+def test_basecache_many(cache):
+    cache.set_many({'a': 1, 'b': [2]}, namespace='many')
+    cache.set_many(((f'k{i}', i) for i in range(2500)), ttl=3600, namespace='many', chunk_size=1000)
+    assert cache.get_many(['a', 'b', 'missing', 'k2499'], namespace='many', default='-') == [1, [2], '-', 2499]
+    assert cache.get_many((f'k{i}' for i in range(2500)), namespace='many') == list(range(2500))
+    cache.delete_many((f'k{i}' for i in range(0, 2500, 2)), namespace='many', chunk_size=100)
+    assert cache.get_many(['k0', 'k1', 'k2', 'k3'], namespace='many') == [None, 1, None, 3]
+    assert cache.get('k1', namespace='many') == 1
+
+
+
+def test_cacheddict_set_many():
+    from flex_cache.memcache import CachedDict, ShardedCachedDict
+    cd = CachedDict(prune_threshold=10)
+    cd.set_many((i, i, 1, ()) for i in range(5))
+    assert [cd.get(i) for i in range(5)] == list(range(5))
+    time.sleep(1.1)
+    # 10 sets hit the prune threshold
+    cd.set_many((i, i, 0, ()) for i in range(5, 10))
+    assert sorted(dict.keys(cd)) == list(range(5, 10))
+    assert cd.delete_many([5, 6, 42]) == 2
+    assert sorted(dict.keys(cd)) == [7, 8, 9]
+
+    sharded = ShardedCachedDict(shards=4)
+    sharded.set_many((i, i, 0, ['all']) for i in range(100))
+    assert [sharded.get(i) for i in range(100)] == list(range(100))
+    assert sharded.delete_many(range(50)) == 50
+    assert len(sharded) == 50
+    assert sharded.delete_index('all') == 50
+    assert len(sharded) == 0
+
 
 def test_cacheddict():
     from flex_cache.memcache import CachedDict, CachedItem
@@ -274,3 +397,822 @@ def test_cacheddict():
                 continue
                 print(f'{k}: {v} vs {time()} - {v.expired()}')
         print(f'cd has {len(cd)} records of which {expired} are expired')
+
+
+def test_single_flight(cache):
+    from concurrent.futures import ThreadPoolExecutor
+    calls = []
+
+    @cache.cache(single_flight=True)
+    def add_single_flight(arg1, arg2):
+        calls.append(1)
+        time.sleep(0.5)
+        return add_func(arg1, arg2)
+
+    with ThreadPoolExecutor(8) as tp:
+        results = list(tp.map(lambda _: add_single_flight(3, 4), range(8)))
+
+    assert len(calls) == 1
+    assert all(r == results[0] for r in results)
+
+
+def test_single_flight_leader_raises(cache):
+    from concurrent.futures import ThreadPoolExecutor
+    calls = []
+
+    @cache.cache(single_flight=True)
+    def fail_single_flight(arg1):
+        calls.append(1)
+        time.sleep(0.5)
+        raise KeyError(arg1)
+
+    def call(_):
+        try:
+            fail_single_flight(1)
+        except KeyError as ke:
+            return ke
+
+    with ThreadPoolExecutor(4) as tp:
+        errors = list(tp.map(call, range(4)))
+
+    assert len(calls) == 1
+    assert all(isinstance(e, KeyError) for e in errors)
+    # failures are not cached - the next caller becomes a new leader
+    with pytest.raises(KeyError):
+        fail_single_flight(1)
+    assert len(calls) == 2
+
+
+def test_single_flight_timeout(cache):
+    from concurrent.futures import ThreadPoolExecutor
+    calls = []
+
+    @cache.cache(single_flight=True, single_flight_timeout=0.1)
+    def slow_single_flight(arg1):
+        calls.append(1)
+        time.sleep(0.5)
+        return arg1
+
+    with ThreadPoolExecutor(2) as tp:
+        first = tp.submit(slow_single_flight, 1)
+        time.sleep(0.05)
+        second = tp.submit(slow_single_flight, 1)
+        assert first.result() == second.result() == 1
+
+    # the waiter gave up after 0.1 seconds and computed the value itself
+    assert len(calls) == 2
+
+
+def test_falsy_results(cache):
+    calls = []
+
+    @cache.cache()
+    def falsy(arg1):
+        calls.append(1)
+        return [0, '', [], None][arg1]
+
+    for i in range(4):
+        assert falsy(i) == falsy(i)
+    assert len(calls) == 4
+
+
+def test_negative_ttl(cache):
+    calls = []
+
+    @cache.cache(negative_ttl=1, negative_exceptions=(KeyError,))
+    def lookup(arg1):
+        calls.append(1)
+        if arg1 == 'missing':
+            raise KeyError(arg1)
+        return None
+
+    assert lookup('none') is None
+    assert lookup('none') is None
+    for _ in range(2):
+        with pytest.raises(KeyError) as ke:
+            lookup('missing')
+        assert ke.value.args == ('missing',)
+    assert len(calls) == 2
+    time.sleep(2)
+    assert lookup('none') is None
+    with pytest.raises(KeyError):
+        lookup('missing')
+    assert len(calls) == 4
+
+
+def test_basecache_get_default(cache):
+    cache.set('setget_none', None, namespace='base')
+    assert cache.get('setget_none', namespace='base', default='x') is None
+    assert cache.get('setget_missing', namespace='base', default='x') == 'x'
+
+
+def test_cacheddict_prune():
+    from flex_cache.memcache import CachedDict
+    cd = CachedDict(prune_threshold=1000)
+    for i in range(100):
+        cd.set(i, i, 0.1 if i % 2 else 0)
+    cd.set(1, 'overwritten', 60)
+    del cd[3]
+    time.sleep(0.2)
+    assert cd._prune() == 48
+    assert len(cd) == 51 and cd.get(1) == 'overwritten'
+    assert len(cd.expiry) == 1
+
+
+def test_reaper():
+    cache = MemCache(reaper_interval=0.1)
+    cache.set('reaped', 'basic', ttl=0.1, namespace='base')
+    cache.set('kept', 'basic', namespace='base')
+    assert len(cache._cache) == 2
+    time.sleep(0.5)
+    assert len(cache._cache) == 1
+    assert cache._cache.prune_count == 0
+    cache._cache.close()
+
+
+def test_sharded_cacheddict():
+    from flex_cache.memcache import CachedDict, ShardedCachedDict
+    from threading import Thread
+    from random import randrange
+    from time import time
+    qty = 5000
+    threads = 32
+    for cd in (CachedDict(), ShardedCachedDict(16)):
+        def add_stuff():
+            for _ in range(qty):
+                cd.set(randrange(10000), 1, 1)
+                cd.get(randrange(10000))
+
+        workers = [Thread(target=add_stuff) for _ in range(threads)]
+        t1 = time()
+        for w in workers:
+            w.start()
+        for w in workers:
+            w.join()
+        d = time() - t1
+        print(f'{type(cd).__name__}: executed {qty * threads} threaded inserts in {d:.2f} seconds')
+        assert len(cd) == len(list(cd)) <= 10000
+
+
+def test_sharded_memcache():
+    cache = MemCache(shards=8)
+
+    @cache.cache()
+    def add_sharded(arg1, arg2):
+        return add_func(arg1, arg2)
+
+    r_3_4, v_3_4 = add_sharded(3, 4)
+    r_4_4, v_4_4 = add_sharded(4, 4)
+    assert v_3_4 == add_sharded(3, 4)[1]
+    add_sharded.invalidate(3, 4)
+    assert v_3_4 != add_sharded(3, 4)[1]
+    add_sharded.invalidate_all()
+    assert v_4_4 != add_sharded(4, 4)[1]
+
+
+def test_store_objects():
+    cache = MemCache(store_objects=True)
+
+    @cache.cache()
+    def add_objects(arg1, arg2):
+        return Result(arg1, arg2)
+
+    r1 = add_objects(2, 3)
+    r2 = add_objects(2, 3)
+    assert r1 is r2
+    assert cache.mget({"fn": add_objects, "args": (2, 3)})[0] is r1
+    cache.set('setget', [1], namespace='base')
+    assert cache.get('setget', namespace='base') == [1]
+
+
+@pytest.mark.parametrize('copy_on_read', ['shallow', 'deepcopy'])
+def test_store_objects_copy(copy_on_read):
+    cache = MemCache(store_objects=True, copy_on_read=copy_on_read)
+
+    @cache.cache()
+    def nested(arg1):
+        return {'values': [arg1]}
+
+    r1 = nested(1)
+    r1['values'].append(2)
+    r1['other'] = 3
+    r2 = nested(1)
+    assert r1 is not r2 and 'other' not in r2
+    assert r2['values'] == ([1] if copy_on_read == 'deepcopy' else [1, 2])
+
+
+def test_store_objects_freeze():
+    cache = MemCache(store_objects=True, copy_on_read='freeze')
+
+    @cache.cache()
+    def nested(arg1):
+        return {'values': [arg1], 'tags': {'a'}}
+
+    r1 = nested(1)
+    assert r1 is nested(1)
+    assert r1['values'] == (1,) and r1['tags'] == frozenset({'a'})
+    with pytest.raises(TypeError):
+        r1['other'] = 3
+
+
+def test_hashed_keys(cache):
+    @cache.cache(key_strategy='hash', key_debug=True)
+    def add_hashed(arg1, filters):
+        return add_func(arg1, len(filters))
+
+    filters = {f'filter{i}': 'x' * 100 for i in range(100)}
+    r_1, v_1 = add_hashed(1, filters)
+    r_2, v_2 = add_hashed(1, filters)
+    assert r_1 == r_2 == 101 and v_1 == v_2
+    key = add_hashed.instance.get_key((1, filters), {})
+    assert len(key) == len(f'rc:{add_hashed.instance.namespace}:') + 32
+    assert 'filter99' in add_hashed.instance.key_args[key]
+    add_hashed.invalidate(1, filters)
+    assert v_1 != add_hashed(1, filters)[1]
+
+
+def test_basecache_hashed_keys():
+    cache = MemCache(key_strategy='hash')
+    cache.set(b'\x00' * 1000, 'basic', namespace='base')
+    assert 'basic' == cache.get(b'\x00' * 1000, namespace='base')
+    assert all(len(k) == len('rc:base:') + 32 for k in cache._cache)
+
+
+def test_normalize_args(cache):
+    calls = []
+
+    @cache.cache(normalize_args=True)
+    def add_normalized(arg1, arg2=2, *args, kwarg1=None, **kwargs):
+        calls.append(1)
+        return add_func(arg1, arg2)
+
+    v = add_normalized(1)[1]
+    assert v == add_normalized(1, 2)[1] == add_normalized(1, arg2=2)[1] == add_normalized(arg2=2, arg1=1)[1]
+    assert v == add_normalized(1, kwarg1=None)[1]
+    assert len(calls) == 1
+    add_normalized(1, 2, 3)
+    add_normalized(1, 2, x=1, y=2)
+    add_normalized(1, 2, y=2, x=1)
+    assert len(calls) == 3
+    add_normalized.invalidate(arg1=1)
+    assert v != add_normalized(1, 2)[1]
+    with pytest.raises(TypeError):
+        add_normalized(arg2=2)
+
+
+def test_coroutine_function(cache):
+    import asyncio
+    calls = []
+
+    @cache.cache(single_flight=True)
+    async def add_async(arg1, arg2):
+        calls.append(1)
+        await asyncio.sleep(0.1)
+        return add_func(arg1, arg2)
+
+    async def check():
+        results = await asyncio.gather(*[add_async(3, 4) for _ in range(4)])
+        assert list(results[0]) == (await add_async(3, 4))
+        return results
+
+    results = asyncio.run(check())
+    assert len(calls) == 1
+    assert all(r == results[0] for r in results)
+
+
+def test_max_entries():
+    cache = MemCache(max_entries=2)
+
+    @cache.cache()
+    def add_bounded(arg1, arg2):
+        return add_func(arg1, arg2)
+
+    r_3_4, v_3_4 = add_bounded(3, 4)
+    r_4_4, v_4_4 = add_bounded(4, 4)
+    r_5_5, v_5_5 = add_bounded(5, 5)  # evicts (3, 4)
+    assert len(cache._cache) == 2
+    assert v_5_5 == add_bounded(5, 5)[1] and v_4_4 == add_bounded(4, 4)[1]
+    assert v_3_4 != add_bounded(3, 4)[1]
+
+
+def test_tags(cache):
+    @cache.cache(tags=lambda customer, item: [f'customer:{customer}'])
+    def get_order(customer, item):
+        return add_func(customer, item)
+
+    @cache.cache(tags='catalog', namespace='tags_catalog')
+    def get_price(item):
+        return add_func(item, 0)
+
+    @cache.cache(tags=lambda customer: ['catalog', f'customer:{customer}'])
+    def get_profile(customer):
+        return add_func(customer, 1)
+
+    o1, o2, price, profile = get_order(1, 10), get_order(2, 10), get_price(10), get_profile(1)
+    cache.invalidate_tags('customer:1')
+    assert get_order(1, 10)[1] != o1[1]
+    assert get_order(2, 10)[1] == o2[1]
+    assert get_price(10)[1] == price[1]
+    assert get_profile(1)[1] != profile[1]
+
+    profile = get_profile(1)
+    cache.invalidate_tags('catalog', 'unknown')
+    assert get_price(10)[1] != price[1]
+    assert get_profile(1)[1] != profile[1]
+    assert get_order(2, 10)[1] == o2[1]
+
+    # values computed by mget are tagged too
+    o3 = cache.mget({"fn": get_order, "args": (3, 10)})[0]
+    assert get_order(3, 10)[1] == o3[1]
+    cache.invalidate_tags('customer:3')
+    assert get_order(3, 10)[1] != o3[1]
+
+
+def test_cacheddict_indexes():
+    from flex_cache.memcache import CachedDict
+    cd = CachedDict(prune_threshold=0)
+    for i in range(4):
+        cd.set(i, i, 1 if i == 3 else 0)
+        cd.add_to_indexes(i, ['even' if i % 2 == 0 else 'odd', 'all'])
+    cd.add_to_indexes('missing', ['all'])
+    assert cd.indexes == {'even': {0, 2}, 'odd': {1, 3}, 'all': {0, 1, 2, 3}}
+
+    del cd[0]  # deleted
+    cd.set(1, 1, 0)  # overwritten - without indexes
+    time.sleep(1.1)
+    assert cd.get(3) is None  # expired
+    assert cd.indexes == {'even': {2}, 'all': {2}}
+
+    assert cd.delete_index('even') == 1
+    assert cd.indexes == {}
+    assert sorted(dict.keys(cd)) == [1]
+
+
+def test_invalidate_all_exact_namespace(cache):
+    @cache.cache(namespace='exact')
+    def add_exact(arg1, arg2):
+        return add_func(arg1, arg2)
+
+    @cache.cache(namespace='exact_too')
+    def add_exact_too(arg1, arg2):
+        return add_func(arg1, arg2)
+
+    r1, r2 = add_exact(1, 1), add_exact_too(1, 1)
+    cache.set('direct', 1, namespace='exact')
+    add_exact.invalidate_all()
+    assert add_exact(1, 1)[1] != r1[1]
+    assert cache.get('direct', namespace='exact') is None
+    # namespaces merely containing the namespace are not invalidated
+    assert add_exact_too(1, 1)[1] == r2[1]
+
+
+@pytest.mark.parametrize('codec', ['zlib', 'lzma', (zlib.compress, zlib.decompress)])
+def test_codec(codec):
+    cache = MemCache(codec=codec, codec_min_size=100)
+
+    @cache.cache()
+    def doc_codec(n):
+        return {'items': ['x' * 10] * n}
+
+    small, large = doc_codec(1), doc_codec(1000)
+    assert doc_codec(1) == small and doc_codec(1000) == large
+    stored_small = doc_codec.instance.check_cache(doc_codec.instance.get_key((1,), {}))
+    stored_large = doc_codec.instance.check_cache(doc_codec.instance.get_key((1000,), {}))
+    assert stored_small[:3] == b'\xff\xfc\x01'  # uncompressed text
+    assert stored_large[:2] == b'\xff\xfc' and stored_large[2] != 0x01 and len(stored_large) < 1000
+    assert cache.mget({"fn": doc_codec, "args": (1000,)}) == [large]
+
+
+def test_codec_mixed_values():
+    from flex_cache.codec import get_codec
+    codec = get_codec('zlib', min_size=10)
+    # values stored without (or with another) codec are decoded too
+    assert codec.decode('["plain"]') == '["plain"]'
+    assert codec.decode(b'\x80\x04pickle') == b'\x80\x04pickle'
+    # msgpack encodes -8..-1 as the single bytes 0xF8-0xFF
+    for negative in range(0xF8, 0x100):
+        assert codec.decode(bytes((negative,))) == bytes((negative,))
+    assert codec.decode(b'\xff\xfc') == b'\xff\xfc'
+    assert codec.decode(get_codec('lzma', 10).encode('x' * 100)) == 'x' * 100
+    assert codec.decode(codec.encode(b'y' * 100)) == b'y' * 100
+    custom = get_codec((zlib.compress, zlib.decompress), 10)
+    assert custom.decode(codec.encode('z' * 100)) == 'z' * 100
+    with pytest.raises(ValueError):
+        codec.decode(custom.encode('z' * 100))  # the zlib codec does not know the custom one
+    with pytest.raises(ValueError):
+        MemCache(store_objects=True, codec='zlib').cache()
+
+
+@pytest.mark.parametrize('serialization', ['pickle', 'msgpack'])
+def test_serialization_presets(serialization):
+    if serialization == 'msgpack':
+        pytest.importorskip('msgpack')
+    from flex_cache.serializers import serialization_options
+    cache = MemCache(**serialization_options(serialization))
+
+    @cache.cache()
+    def binary_preset(arg1, arg2):
+        return {'sum': arg1 + arg2, 'blob': b'\x00\xff', 'verifier': str(uuid.uuid4())}
+
+    r1 = binary_preset(1, 2)
+    assert binary_preset(1, 2) == r1
+    key = binary_preset.instance.get_key((1, 2), {})
+    # keys are digests, not base64 encoded bytes
+    assert len(key.rsplit(':', 1)[1]) == 32
+    assert isinstance(binary_preset.instance.check_cache(key), bytes)
+    cache.set(b'\x01bytes-key', [1, 2])
+    assert cache.get(b'\x01bytes-key') in ([1, 2], (1, 2))
+
+
+@pytest.mark.parametrize('serialization', ['pickle', 'msgpack'])
+def test_serialization_presets_canonical_keys(serialization):
+    if serialization == 'msgpack':
+        pytest.importorskip('msgpack')
+    from flex_cache.serializers import serialization_options
+    cache = MemCache(**serialization_options(serialization))
+
+    @cache.cache()
+    def binary_keys(arg1, arg2):
+        return str(uuid.uuid4())
+
+    s = 'abc'
+    # pickle memoizes the repeated object, so its output differs from that of equal distinct strings
+    assert binary_keys(s, s) == binary_keys(s, ''.join(['a', 'bc']))
+    assert binary_keys({'x', 'y', 'z', 'w'}, b'\x00') == binary_keys({'w', 'z', 'y', 'x'}, b'\x00')
+    assert binary_keys([1], 2) != binary_keys({1}, 2)
+    # the same key in every process - whatever its hash seed
+    code = ('from flex_cache import MemCache; from flex_cache.serializers import serialization_options; '
+            f'print(MemCache(**serialization_options("{serialization}")).cache(namespace="ns")(len)'
+            '.instance.get_key(({"x", "y", "z", "w"},), {}))')
+    keys = {subprocess.run([sys.executable, '-c', code], env=dict(os.environ, PYTHONHASHSEED=str(seed)),
+                           check=True, capture_output=True, text=True).stdout for seed in range(3)}
+    assert len(keys) == 1
+
+
+def test_serialization_benchmark():
+    """
+    json vs the binary presets, on 1000 orders of a customer:
+    json: 100 dumps + loads of 266KB in 1.58s
+    pickle: 100 dumps + loads of 143KB in 0.49s
+    """
+    from flex_cache.serializers import PRESETS
+    orders = [{'id': i, 'customer': {'id': 42, 'name': 'Jane Doe', 'email': 'jane@example.com'},
+               'lines': [{'sku': f'SKU-{i}-{j}', 'qty': j, 'price': 9.95 * j} for j in range(3)],
+               'status': 'shipped', 'total': 59.7} for i in range(1000)]
+    for name, (dumps, loads, _) in PRESETS.items():
+        start = time.time()
+        for _ in range(100):
+            data = dumps(orders)
+            assert len(loads(data)) == 1000
+        print(f'{name}: 100 dumps + loads of {len(data) // 1024}KB in {time.time() - start:.2f}s')
+
+
+def test_stale_while_revalidate(cache):
+    calls = []
+    release = threading.Event()
+    executor = ThreadPoolExecutor(max_workers=4)
+
+    @cache.cache(ttl=0.2, stale_ttl=5, refresh_executor=executor)
+    def add_stale(arg1, arg2):
+        calls.append(1)
+        if len(calls) > 1:
+            release.wait(5)
+        return add_func(arg1, arg2)
+
+    v = list(add_stale(1, 2))
+    time.sleep(0.3)
+    # stale values are served, while exactly one background refresh recomputes them
+    assert all(add_stale(1, 2) == v for _ in range(5))
+    release.set()
+    executor.shutdown(wait=True)
+    assert len(calls) == 2
+    assert add_stale(1, 2) != v
+
+
+def test_stale_while_revalidate_expired(cache):
+    @cache.cache(ttl=0.1, stale_ttl=0.1)
+    def add_stale(arg1, arg2):
+        return add_func(arg1, arg2)
+
+    v = list(add_stale(1, 2))
+    time.sleep(0.3)
+    # past ttl + stale_ttl, values are recomputed in the foreground
+    assert add_stale(1, 2) != v
+    with pytest.raises(ValueError):
+        cache.cache(stale_ttl=1)
+
+
+def test_stale_while_revalidate_coroutine(cache):
+    calls = []
+
+    @cache.cache(ttl=0.2, stale_ttl=5)
+    async def add_stale(arg1, arg2):
+        calls.append(1)
+        await asyncio.sleep(0.05)
+        return add_func(arg1, arg2)
+
+    async def check():
+        v = list(await add_stale(1, 2))
+        await asyncio.sleep(0.3)
+        stale = await asyncio.gather(*[add_stale(1, 2) for _ in range(4)])
+        await asyncio.sleep(0.2)
+        return v, stale, await add_stale(1, 2)
+
+    v, stale, refreshed = asyncio.run(check())
+    assert all(s == v for s in stale)
+    assert refreshed != v
+    assert len(calls) == 2
+
+
+def test_early_recompute(cache, monkeypatch):
+    import flex_cache.basecache
+    monkeypatch.setattr(flex_cache.basecache, 'random', lambda: 0.5)  # -log(0.5) ~ 0.69
+    calls = []
+    executor = ThreadPoolExecutor(max_workers=4)
+
+    @cache.cache(ttl=1, early_recompute=10, refresh_executor=executor)
+    def add_early(arg1, arg2):
+        calls.append(1)
+        time.sleep(0.05)  # recomputed once less than ~0.35s (0.05 * 10 * 0.69) remain
+        return add_func(arg1, arg2)
+
+    v = list(add_early(1, 2))
+    assert add_early(1, 2) == v
+    assert cache.mget({"fn": add_early, "args": (1, 2)})[0] == v
+    assert len(calls) == 1
+    time.sleep(0.75)
+    assert add_early(1, 2) == v  # served, while recomputed early in the background
+    executor.shutdown(wait=True)
+    assert len(calls) == 2
+    assert add_early(1, 2) != v
+
+
+def test_ttl_jitter(cache):
+    @cache.cache(ttl=100, ttl_jitter=0.5)
+    def add_jitter(arg1, arg2):
+        return add_func(arg1, arg2)
+
+    for i in range(20):
+        add_jitter(i, i)
+    durations = {item.duration for item in cache._cache.values()
+                 if item.key.startswith(add_jitter.instance.namespace, len(cache.prefix) + 1)}
+    assert len(durations) > 10
+    assert all(50 <= d <= 100 for d in durations)
+
+
+def test_refresh_ahead(cache):
+    from flex_cache import RefreshAheadScheduler
+    scheduler = RefreshAheadScheduler(max_keys=3, min_hits=2, lead_time=0.3, interval=0.05)
+    calls = []
+
+    @cache.cache(ttl=0.5, refresh_ahead=scheduler)
+    def add_ahead(arg1, arg2=0):
+        calls.append((arg1, arg2))
+        return add_func(arg1, arg2)
+
+    hot, cold = list(add_ahead(1, arg2=2)), list(add_ahead(2))
+    add_ahead(1, arg2=2), add_ahead(1, arg2=2), add_ahead(2)
+    time.sleep(0.35)
+    # the hot key was recomputed (with the recorded arguments) before it expired - the cold one is left to expire
+    assert calls == [(1, 2), (2, 0), (1, 2)]
+    assert add_ahead(1, arg2=2) != hot
+    assert len(scheduler) == 1
+    time.sleep(0.3)
+    assert add_ahead(2) != cold
+
+    # at most max_keys keys are tracked
+    for i in range(10):
+        add_ahead(i, arg2=i)
+    assert len(scheduler) == 3
+    scheduler.close()
+
+    with pytest.raises(ValueError):
+        @cache.cache(ttl=1, refresh_ahead=scheduler)
+        async def add_async(arg1):
+            return arg1
+
+
+def test_refresh_ahead_bounded(cache):
+    from flex_cache import RefreshAheadScheduler
+    from flex_cache.refresh import COMPACT_SLACK
+    scheduler = RefreshAheadScheduler(max_keys=10, interval=60)
+
+    @cache.cache(ttl=3600, refresh_ahead=scheduler)
+    def add_bounded(arg1, arg2):
+        return add_func(arg1, arg2)
+
+    for i in range(2000):
+        add_bounded(i, i)
+    # the due refreshes of untracked keys are dropped from the heap
+    assert len(scheduler) == 10
+    assert len(scheduler.due) <= 2 * 10 + COMPACT_SLACK + 1
+    scheduler.close()
+
+
+def test_metrics():
+    cache = MemCache(metrics=True)
+
+    @cache.cache(ttl=10, negative_exceptions=(KeyError,))
+    def add_metered(arg1, arg2):
+        if arg1 < 0:
+            raise KeyError(arg1)
+        return add_func(arg1, arg2)
+
+    add_metered(1, 2), add_metered(1, 2), add_metered(2, 2)
+    threads = [threading.Thread(target=add_metered, args=(1, 2)) for _ in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    with pytest.raises(KeyError):
+        add_metered(-1, 2)
+    info = add_metered.cache_info()
+    assert (info.hits, info.misses, info.sets, info.evictions, info.errors) == (5, 3, 3, 0, 1)
+    assert info.read.count == 8 and info.write.count == 3 and info.compute.count == 3
+    assert sum(info.compute.buckets) == 3 and info.compute.sum > 0
+    assert cache.metrics.snapshot() == {add_metered.instance.namespace: info}
+
+    text = cache.metrics.prometheus()
+    assert f'flex_cache_hits_total{{namespace="{add_metered.instance.namespace}"}} 5\n' in text
+    assert f'flex_cache_read_seconds_count{{namespace="{add_metered.instance.namespace}"}} 8\n' in text
+    assert '# TYPE flex_cache_compute_seconds histogram\n' in text
+
+
+def test_metrics_single_flight():
+    cache = MemCache(metrics=True)
+
+    @cache.cache(single_flight=True)
+    def add_metered_flight(arg1, arg2):
+        return add_func(arg1, arg2)
+
+    @cache.cache(single_flight=True)
+    async def aadd_metered_flight(arg1, arg2):
+        return add_func(arg1, arg2)
+
+    async def acalls():
+        await aadd_metered_flight(1, 2)
+        await aadd_metered_flight(1, 2)
+
+    add_metered_flight(1, 2), add_metered_flight(1, 2)
+    asyncio.run(acalls())
+    for fn in (add_metered_flight, aadd_metered_flight):
+        info = fn.cache_info()
+        assert (info.hits, info.misses, info.sets) == (1, 1, 1)
+        assert info.read.count == 2
+
+
+def test_metrics_evictions():
+    cache = MemCache(metrics=True, max_entries=2)
+
+    @cache.cache()
+    def add_metered_limit(arg1, arg2):
+        return add_func(arg1, arg2)
+
+    for i in range(5):
+        add_metered_limit(i, i)
+    info = add_metered_limit.cache_info()
+    assert (info.misses, info.sets, info.evictions) == (5, 5, 3)
+    assert len(cache._cache) == 2
+
+
+def test_metrics_dead_threads():
+    cache = MemCache(metrics=True)
+
+    @cache.cache(ttl=10)
+    def add_threaded(arg1, arg2):
+        return add_func(arg1, arg2)
+
+    add_threaded(1, 2)
+    for _ in range(20):
+        thread = threading.Thread(target=add_threaded, args=(1, 2))
+        thread.start()
+        thread.join()
+        del thread
+    gc.collect()
+    metrics = add_threaded.instance.metrics
+    assert len(metrics._counters) == 1  # of the main thread
+    info = add_threaded.cache_info()
+    assert (info.hits, info.misses, info.sets) == (20, 1, 1)
+    assert info.read.count == 21 and sum(info.read.buckets) == 21
+
+
+def test_metrics_disabled(cache):
+    @cache.cache()
+    def add_unmetered(arg1, arg2):
+        return add_func(arg1, arg2)
+
+    assert 'check_cache' not in vars(add_unmetered.instance)
+    with pytest.raises(ValueError):
+        add_unmetered.cache_info()
+
+
+def test_metrics_coroutine_function():
+    cache = MemCache(metrics=True)
+
+    @cache.cache()
+    async def add_metered(arg1, arg2):
+        return add_func(arg1, arg2)
+
+    async def check():
+        for _ in range(3):
+            await add_metered(1, 2)
+
+    asyncio.run(check())
+    info = add_metered.cache_info()
+    assert (info.hits, info.misses, info.sets, info.compute.count) == (2, 1, 1, 1)
+
+
+def test_profiler(cache):
+    profiles = []
+
+    @cache.cache(profiler=profiles.append)
+    def add_profiled(arg1, arg2):
+        return add_func(arg1, arg2)
+
+    add_profiled(1, 2)
+    add_profiled(1, 2)
+    miss, hit = profiles
+    assert miss.name == hit.name == add_profiled.instance.namespace
+    assert [p.name for p in miss.phases] == ['filter_args', 'key', 'backend_read', 'compute', 'serialize',
+                                             'backend_write']
+    assert [p.name for p in hit.phases] == ['filter_args', 'key', 'backend_read', 'deserialize']
+    key = add_profiled.instance.get_key((1, 2), {})
+    serialized = add_profiled.instance.cache.get(key)
+    assert miss.phases[1].size == len(key)
+    assert miss.phases[4].size == miss.phases[5].size == hit.phases[2].size == hit.phases[3].size == len(serialized)
+    assert all(p.seconds >= 0 for p in miss.phases) and miss.seconds >= sum(p.seconds for p in miss.phases[1:])
+
+
+def test_profiler_sampling(cache):
+    from flex_cache.profiling import Profiler
+    profiles = []
+
+    @cache.cache(profiler=Profiler(profiles.append, sample_rate=0))
+    def add_unsampled(arg1, arg2):
+        return add_func(arg1, arg2)
+
+    add_unsampled(1, 2), add_unsampled(1, 2)
+    assert profiles == []
+    # functions without a profiler are not wrapped
+    assert not {'get_key', 'check_cache', 'original_fn'} & set(vars(cache.cache()(add_func).instance)) - {'original_fn'}
+
+
+def test_profiler_imported_lazily():
+    code = ('import sys, flex_cache; flex_cache.MemCache().cache()(len); '
+            'assert "flex_cache.profiling" not in sys.modules')
+    subprocess.run([sys.executable, '-c', code], check=True)
+
+
+def test_profiler_mget():
+    profiles = []
+    cache = MemCache(profiler=profiles.append)
+
+    @cache.cache()
+    def add_profiled(arg1, arg2):
+        return add_func(arg1, arg2)
+
+    add_profiled(1, 2)
+    del profiles[:]
+    cache.mget({"fn": add_profiled, "args": (1, 2)}, {"fn": add_profiled, "args": (3, 4)})
+    profile, = profiles
+    assert profile.name == 'mget'
+    # MemCache reads the keys of a batch one by one - within the backend read of the batch
+    assert [p.name for p in profile.phases] == ['filter_args', 'key', 'filter_args', 'key', 'backend_read',
+                                                'backend_read', 'backend_read', 'deserialize', 'compute',
+                                                'compute_misses', 'serialize', 'backend_write']
+
+
+def test_profiler_bulk():
+    profiles = []
+    cache = MemCache(profiler=profiles.append)
+
+    cache.set_many({'a': 1, 'b': 2}, namespace='bulk')
+    assert cache.get_many(['a', 'b', 'c'], namespace='bulk') == [1, 2, None]
+    cache.delete_many(['a'], namespace='bulk')
+    assert [p.name for p in profiles] == ['set_many', 'get_many', 'delete_many']
+    assert [[phase.name for phase in p.phases] for p in profiles] == [['backend_write'], ['backend_read'],
+                                                                        ['backend_write']]
+    assert profiles[0].phases[0].size == profiles[1].phases[0].size == len('1') + len('2')
+
+
+def test_key_debug_threads(cache):
+    @cache.cache(key_strategy='hash', key_debug=True, key_debug_size=2)
+    def add_debugged(arg1, arg2):
+        return arg1 + arg2
+
+    errors = []
+
+    def call_many(offset):
+        try:
+            for i in range(2000):
+                add_debugged.instance.get_key((offset, i % 5), {})
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=call_many, args=(i,)) for i in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert errors == []
+    assert len(add_debugged.instance.key_args) == 2
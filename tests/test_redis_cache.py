@@ -1,5 +1,7 @@
+import json
 import uuid
 import time
+from concurrent.futures import ThreadPoolExecutor
 
 from redis import StrictRedis
 from flex_cache import RedisCache
@@ -91,6 +93,53 @@ def test_limit(cache):
     assert r2_3_4 == r3_3_4 and v2_3_4 == v3_3_4
 
 
+def test_limit_lru(cache):
+    @cache.cache(limit=2, eviction_policy='lru')
+    def add_limit_lru(arg1, arg2):
+        return add_func(arg1, arg2)
+
+    r_3_4, v_3_4 = add_limit_lru(3, 4)
+    r_5_5, v_5_5 = add_limit_lru(5, 5)
+    assert add_limit_lru(3, 4)[1] == v_3_4  # hit - (3, 4) is now the most recently used
+    add_limit_lru(6, 5)  # evicts (5, 5), the least recently used
+
+    assert add_limit_lru(3, 4)[1] == v_3_4
+    assert add_limit_lru(5, 5)[1] != v_5_5
+
+
+def test_limit_lfu(cache):
+    @cache.cache(limit=2, eviction_policy='lfu')
+    def add_limit_lfu(arg1, arg2):
+        return add_func(arg1, arg2)
+
+    r_3_4, v_3_4 = add_limit_lfu(3, 4)
+    r_5_5, v_5_5 = add_limit_lfu(5, 5)
+    for _ in range(3):
+        assert add_limit_lfu(5, 5)[1] == v_5_5
+    add_limit_lfu(6, 5)  # evicts (3, 4), the least frequently used
+    assert cache.mget({"fn": add_limit_lfu, "args": (5, 5)})[0][1] == v_5_5
+
+    assert add_limit_lfu(3, 4)[1] != v_3_4  # evicts (6, 5) - new keys are never evicted by their own set
+    assert add_limit_lfu(5, 5)[1] == v_5_5
+
+
+def test_limit_scores(cache):
+    @cache.cache(limit=5, eviction_policy='lfu', namespace='lfu_scores')
+    def add_limit_scores(arg1, arg2):
+        return add_func(arg1, arg2)
+
+    add_limit_scores(1, 1)
+    add_limit_scores(1, 1)
+    cache.mget({"fn": add_limit_scores, "args": (1, 1)})
+    keys_key = add_limit_scores.instance.keys_key
+    assert client.zscore(keys_key, add_limit_scores.instance.get_key((1, 1), {})) == 3
+
+
+def test_unsupported_eviction_policy(cache):
+    with pytest.raises(ValueError):
+        cache.cache(limit=2, eviction_policy='random')
+
+
 def test_invalidate_not_in_cache(cache):
     @cache.cache()
     def add_invalidate_not_in_cache(arg1, arg2):
@@ -161,6 +210,61 @@ def test_invalidate_all():
     # caches of f2222_invalidate_all should stay stored
     assert r_5_5 == r2_5_5 and v_5_5 == v2_5_5
 
+def test_invalidate_all_index():
+    cache = RedisCache(redis_client=client)
+
+    @cache.cache(ttl=60, namespace='index')
+    def add_index(arg1, arg2):
+        return add_func(arg1, arg2)
+
+    @cache.cache(ttl=1, namespace='index')
+    def add_index_short(arg1, arg2):
+        return add_func(arg1, arg2)
+
+    keys_key = add_index.instance.keys_key
+    for i in range(1200):
+        add_index(i, i)
+    add_index_short(1, 1.5)
+    # every key is indexed (scored by its expiry time), and the index outlives them
+    assert client.zcard(keys_key) == 1201
+    assert 55 < client.ttl(keys_key) <= 60
+    time.sleep(2.1)
+    add_index(-1, -1)  # drops the expired key from the index
+    assert client.zcard(keys_key) == 1201
+    assert client.zscore(keys_key, add_index_short.instance.get_key((1, 1.5), {})) is None
+
+    cache.set('persistent', 1, namespace='index')
+    assert client.ttl(keys_key) == -1
+
+    add_index.invalidate_all()
+    assert not client.exists(keys_key)
+
+
+def test_invalidate_all_set_namespace(cache):
+    cache.set('a', 1, namespace='set_only')
+    cache.set_many({'b': 2, 'c': 3}, ttl=60, namespace='set_only')
+    cache.cache(namespace='set_only').invalidate_all()
+    assert cache.get_many(['a', 'b', 'c'], namespace='set_only', default='-') == ['-', '-', '-']
+    assert not client.exists('rc:set_only:keys')
+
+
+def test_invalidate_all_hashed_keys():
+    hashed = RedisCache(redis_client=client, key_strategy='hash')
+
+    @hashed.cache(namespace='hashed_ns')
+    def add_hashed_ns(arg1, arg2):
+        return add_func(arg1, arg2)
+
+    add_hashed_ns(1, 2)
+    hashed.set('b', 2, namespace='hashed_ns')
+    assert add_hashed_ns.instance.keys_key == 'rc:hashed_ns:keys'
+    assert client.zcard('rc:hashed_ns:keys') == 2
+    add_hashed_ns.invalidate_all()
+    assert hashed.get('b', namespace='hashed_ns', default='-') == '-'
+    assert client.keys('rc:hashed_ns:*') == []
+    assert not list(client.scan_iter('rc:index:*'))
+
+
 
 class Result:
     def __init__(self, arg1, arg2):
@@ -222,6 +326,40 @@ def test_basic_mget(cache):
     assert r_3_4 == r2_3_4 and v_3_4 == v2_3_4
 
 
+def test_mget_positional(cache):
+    calls = []
+
+    @cache.cache()
+    def add_mget(arg1, arg2):
+        calls.append((arg1, arg2))
+        return arg1 + arg2
+
+    add_mget(3, 4)
+    results = cache.mget({"fn": add_mget, "args": (5, 6)},
+                         {"fn": add_mget, "args": (3, 4)},
+                         {"fn": add_mget, "kwargs": {"arg1": 1, "arg2": 1}})
+    assert results == [11, 7, 2]
+    assert calls == [(3, 4), (5, 6), (1, 1)]
+    # the misses were cached
+    assert cache.mget({"fn": add_mget, "args": (5, 6)}, {"fn": add_mget, "kwargs": {"arg1": 1, "arg2": 1}}) == [11, 2]
+    assert add_mget(5, 6) == 11
+    assert len(calls) == 3
+
+
+def test_mget_thread_executor(cache):
+    @cache.cache()
+    def slow_add(arg1, arg2):
+        time.sleep(0.05)
+        return arg1 + arg2
+
+    start = time.time()
+    with ThreadPoolExecutor(max_workers=10) as executor:
+        results = cache.mget(*[{"fn": slow_add, "args": (n, n)} for n in range(20)], executor=executor)
+    assert results == [n + n for n in range(20)]
+    assert time.time() - start < 0.05 * 20 / 2
+    assert cache.mget({"fn": slow_add, "args": (7, 7)}) == [14]
+
+
 def test_basecache_setget(cache):
     cache.set('setget', 'basic', namespace='base')
     assert 'basic' == cache.get('setget', namespace='base')
@@ -239,3 +377,386 @@ def test_basecache_invalidate(cache):
     cache.invalidate('setget', namespace='base')
     assert cache.get('setget', namespace='base') is None
     assert cache.get('setget2', namespace='base') == 'basic2'
+
+def test_basecache_many(cache):
+    cache.set_many({'a': 1, 'b': [2]}, namespace='many')
+    cache.set_many(((f'k{i}', i) for i in range(2500)), ttl=3600, namespace='many', chunk_size=1000)
+    assert cache.get_many(['a', 'b', 'missing', 'k2499'], namespace='many', default='-') == [1, [2], '-', 2499]
+    assert cache.get_many((f'k{i}' for i in range(2500)), namespace='many') == list(range(2500))
+    cache.delete_many((f'k{i}' for i in range(0, 2500, 2)), namespace='many', chunk_size=100)
+    assert cache.get_many(['k0', 'k1', 'k2', 'k3'], namespace='many') == [None, 1, None, 3]
+    assert cache.get('k1', namespace='many') == 1
+
+
+
+def test_single_flight(cache):
+    from concurrent.futures import ThreadPoolExecutor
+    calls = []
+
+    @cache.cache(single_flight=True)
+    def add_single_flight(arg1, arg2):
+        calls.append(1)
+        time.sleep(0.5)
+        return add_func(arg1, arg2)
+
+    with ThreadPoolExecutor(8) as tp:
+        results = list(tp.map(lambda _: add_single_flight(3, 4), range(8)))
+
+    assert len(calls) == 1
+    assert all(r == results[0] for r in results)
+
+
+def test_lease(cache):
+    from concurrent.futures import ThreadPoolExecutor
+    calls = []
+
+    def add_lease(arg1, arg2):
+        calls.append(1)
+        time.sleep(0.5)
+        return add_func(arg1, arg2)
+
+    # separate decorator instances - like separate worker processes sharing the same redis
+    workers = [RedisCache(redis_client=client).cache(lease_ttl=5, namespace='lease')(add_lease) for _ in range(4)]
+    with ThreadPoolExecutor(4) as tp:
+        results = list(tp.map(lambda worker: worker(3, 4), workers))
+
+    assert len(calls) == 1
+    assert all(list(r) == list(results[0]) for r in results)
+
+
+def test_lease_expires(cache):
+    @cache.cache(lease_ttl=2, namespace='lease_expires')
+    def add_lease_expires(arg1, arg2):
+        return add_func(arg1, arg2)
+
+    # simulate a crashed leader, holding the lease for 0.3 seconds
+    key = add_lease_expires.instance.get_key((3, 4), {})
+    client.set(f'{key}:lease', 'crashed', px=300)
+    t1 = time.time()
+    r_3_4, v_3_4 = add_lease_expires(3, 4)
+    assert 7 == r_3_4 and 0.3 <= time.time() - t1 < 2
+
+
+def test_falsy_results(cache):
+    calls = []
+
+    @cache.cache()
+    def falsy(arg1):
+        calls.append(1)
+        return [0, '', [], None][arg1]
+
+    for i in range(4):
+        assert falsy(i) == falsy(i)
+    assert len(calls) == 4
+
+
+def test_negative_ttl(cache):
+    calls = []
+
+    @cache.cache(negative_ttl=1, negative_exceptions=(KeyError,))
+    def lookup(arg1):
+        calls.append(1)
+        if arg1 == 'missing':
+            raise KeyError(arg1)
+        return None
+
+    assert lookup('none') is None
+    assert lookup('none') is None
+    for _ in range(2):
+        with pytest.raises(KeyError) as ke:
+            lookup('missing')
+        assert ke.value.args == ('missing',)
+    assert len(calls) == 2
+    time.sleep(2)
+    assert lookup('none') is None
+    with pytest.raises(KeyError):
+        lookup('missing')
+    assert len(calls) == 4
+
+
+def test_fractional_negative_ttl(cache):
+    calls = []
+
+    @cache.cache(negative_ttl=0.5)
+    def lookup_fractional(arg1):
+        calls.append(1)
+        return None
+
+    assert lookup_fractional('none') is None
+    assert lookup_fractional('none') is None
+    assert len(calls) == 1
+    assert 0 < client.pttl(lookup_fractional.instance.get_key(('none',), {})) <= 500
+
+
+def test_basecache_get_default(cache):
+    cache.set('setget_none', None, namespace='base')
+    assert cache.get('setget_none', namespace='base', default='x') is None
+    assert cache.get('setget_missing', namespace='base', default='x') == 'x'
+
+
+def test_hashed_keys(cache):
+    @cache.cache(key_strategy='hash', key_debug=True)
+    def add_hashed(arg1, filters):
+        return add_func(arg1, len(filters))
+
+    filters = {f'filter{i}': 'x' * 100 for i in range(100)}
+    r_1, v_1 = add_hashed(1, filters)
+    r_2, v_2 = add_hashed(1, filters)
+    assert r_1 == r_2 == 101 and v_1 == v_2
+    key = add_hashed.instance.get_key((1, filters), {})
+    assert len(key) == len(f'rc:{add_hashed.instance.namespace}:') + 32
+    assert 'filter99' in add_hashed.instance.key_args[key]
+    add_hashed.invalidate(1, filters)
+    assert v_1 != add_hashed(1, filters)[1]
+
+
+def test_normalize_args(cache):
+    calls = []
+
+    @cache.cache(normalize_args=True)
+    def add_normalized(arg1, arg2=2, *args, kwarg1=None, **kwargs):
+        calls.append(1)
+        return add_func(arg1, arg2)
+
+    v = add_normalized(1)[1]
+    assert v == add_normalized(1, 2)[1] == add_normalized(1, arg2=2)[1] == add_normalized(arg2=2, arg1=1)[1]
+    assert v == add_normalized(1, kwarg1=None)[1]
+    assert len(calls) == 1
+    add_normalized(1, 2, 3)
+    add_normalized(1, 2, x=1, y=2)
+    add_normalized(1, 2, y=2, x=1)
+    assert len(calls) == 3
+    add_normalized.invalidate(arg1=1)
+    assert v != add_normalized(1, 2)[1]
+    with pytest.raises(TypeError):
+        add_normalized(arg2=2)
+
+
+def test_tags(cache):
+    @cache.cache(tags=lambda customer, item: [f'customer:{customer}'])
+    def get_order(customer, item):
+        return add_func(customer, item)
+
+    @cache.cache(tags='catalog', namespace='tags_catalog')
+    def get_price(item):
+        return add_func(item, 0)
+
+    @cache.cache(tags=lambda customer: ['catalog', f'customer:{customer}'])
+    def get_profile(customer):
+        return add_func(customer, 1)
+
+    o1, o2, price, profile = get_order(1, 10), get_order(2, 10), get_price(10), get_profile(1)
+    cache.invalidate_tags('customer:1')
+    assert get_order(1, 10)[1] != o1[1]
+    assert get_order(2, 10)[1] == o2[1]
+    assert get_price(10)[1] == price[1]
+    assert get_profile(1)[1] != profile[1]
+
+    profile = get_profile(1)
+    cache.invalidate_tags('catalog', 'unknown')
+    assert get_price(10)[1] != price[1]
+    assert get_profile(1)[1] != profile[1]
+    assert get_order(2, 10)[1] == o2[1]
+
+    # values computed by mget are tagged too
+    o3 = cache.mget({"fn": get_order, "args": (3, 10)})[0]
+    assert get_order(3, 10)[1] == o3[1]
+    cache.invalidate_tags('customer:3')
+    assert get_order(3, 10)[1] != o3[1]
+
+
+
+def test_tags_namespace_index(cache):
+    @cache.cache(limit=3, eviction_policy='lfu', tags='t_limit')
+    def get_limited(item):
+        return add_func(item, 0)
+
+    @cache.cache(tags='t_limit')
+    def get_unlimited(item):
+        return add_func(item, 1)
+
+    get_limited.invalidate_all()
+    get_unlimited.invalidate_all()
+    for i in range(3):
+        get_limited(i), get_limited(i), get_unlimited(i)
+    cache.invalidate_tags('t_limit')
+    # the invalidated keys are dropped from their namespace index too
+    assert client.zcard(get_limited.instance.keys_key) == 0
+    assert client.zcard(get_unlimited.instance.keys_key) == 0
+    assert not client.exists('rc:tag:t_limit')
+    values = [get_limited(i) for i in range(3, 6)]
+    assert [get_limited(i) for i in range(3, 6)] == [list(v) for v in values]
+
+
+def test_codec():
+    cache = RedisCache(redis_client=client_no_decode, codec='zlib', codec_min_size=100)
+
+    @cache.cache(namespace='codec')
+    def doc_codec(n):
+        return {'items': ['x' * 10] * n}
+
+    large = doc_codec(1000)
+    assert doc_codec(1000) == large
+    assert len(client_no_decode.get(doc_codec.instance.get_key((1000,), {}))) < 1000
+    cache.set('direct', large, namespace='codec')
+    assert cache.get('direct', namespace='codec') == large
+    assert cache.mget({"fn": doc_codec, "args": (1000,)}) == [large]
+
+
+def test_codec_decode_responses():
+    with pytest.raises(ValueError):
+        RedisCache(redis_client=client, codec='zlib').cache()
+
+
+def test_codec_settings():
+    from flex_cache import init_cache_from_settings
+    cache = init_cache_from_settings({'type': 'RedisCache', 'redis_host': redis_host, 'codec': 'zlib'})
+    assert cache._cache.connection_pool.connection_kwargs['decode_responses'] is False
+    cache.set('settings', 'x' * 2000, namespace='codec')
+    assert cache.get('settings', namespace='codec') == 'x' * 2000
+
+
+def test_serialization_preset():
+    from flex_cache import init_cache_from_settings
+    cache = init_cache_from_settings({'type': 'RedisCache', 'redis_host': redis_host, 'serialization': 'pickle'})
+
+    @cache.cache()
+    def pickle_preset(arg1, arg2):
+        return add_func(arg1, arg2)
+
+    r1 = pickle_preset(3, 4)
+    assert pickle_preset(3, 4) == r1  # pickle keeps the tuple
+    with pytest.raises(ValueError):
+        from flex_cache.serializers import serialization_options
+        RedisCache(redis_client=client, **serialization_options('pickle')).cache()
+
+
+def test_stale_while_revalidate(cache):
+    calls = []
+    executor = ThreadPoolExecutor(max_workers=4)
+
+    @cache.cache(ttl=1, stale_ttl=5, refresh_executor=executor)
+    def add_stale(arg1, arg2):
+        calls.append(1)
+        return add_func(arg1, arg2)
+
+    v = list(add_stale(1, 2))
+    assert 4 < client.ttl(add_stale.instance.get_key((1, 2), {})) <= 6  # kept for ttl + stale_ttl
+    time.sleep(1.1)
+    assert add_stale(1, 2) == v  # stale
+    executor.shutdown(wait=True)
+    assert len(calls) == 2
+    assert add_stale(1, 2) != v
+
+
+def test_stale_while_revalidate_refresh_lock(cache):
+    # another worker holds the refresh lock, so this one keeps serving the stale value
+    executor = ThreadPoolExecutor(max_workers=4)
+
+    @cache.cache(ttl=1, stale_ttl=5, refresh_executor=executor)
+    def add_stale_locked(arg1, arg2):
+        return add_func(arg1, arg2)
+
+    v = list(add_stale_locked(1, 2))
+    key = add_stale_locked.instance.get_key((1, 2), {})
+    client.set(f'{key}:refresh', 'other worker', px=5000)
+    time.sleep(1.1)
+    assert add_stale_locked(1, 2) == v
+    executor.shutdown(wait=True)
+    assert json.loads(client.get(key)) == v
+    client.delete(f'{key}:refresh')
+
+
+def test_early_recompute(cache, monkeypatch):
+    import flex_cache.basecache
+    monkeypatch.setattr(flex_cache.basecache, 'random', lambda: 0.5)
+    executor = ThreadPoolExecutor(max_workers=4)
+
+    @cache.cache(ttl=4, early_recompute=60, refresh_executor=executor, negative_exceptions=(KeyError,))
+    def add_early(arg1, arg2):
+        if arg1 < 0:
+            raise KeyError(arg1)
+        time.sleep(0.05)  # recomputed once less than ~2s (0.05 * 60 * 0.69) remain
+        return add_func(arg1, arg2)
+
+    v = list(add_early(1, 2))
+    stored = json.loads(client.get(add_early.instance.get_key((1, 2), {})))
+    assert stored['value'] == v and stored['__flex_cache_delta__'] >= 0.05
+    assert add_early(1, 2) == v
+    for _ in range(2):
+        with pytest.raises(KeyError):
+            add_early(-1, 2)
+    time.sleep(2.2)
+    assert add_early(1, 2) == v
+    executor.shutdown(wait=True)
+    assert add_early(1, 2) != v
+
+
+def test_ttl_jitter(cache):
+    @cache.cache(ttl=100, ttl_jitter=0.5)
+    def add_jitter(arg1, arg2):
+        return add_func(arg1, arg2)
+
+    ttls = set()
+    for i in range(20):
+        add_jitter(i, i)
+        ttls.add(client.ttl(add_jitter.instance.get_key((i, i), {})))
+    assert len(ttls) > 5
+    assert all(49 <= t <= 100 for t in ttls)
+
+
+def test_float_ttl_jitter(cache):
+    @cache.cache(ttl=60.0, ttl_jitter=0.5)
+    def add_float_jitter(arg1, arg2):
+        return add_func(arg1, arg2)
+
+    v = list(add_float_jitter(1, 2))
+    assert add_float_jitter(1, 2) == v
+    assert 30000 <= client.pttl(add_float_jitter.instance.get_key((1, 2), {})) <= 60000
+
+
+def test_refresh_ahead(cache):
+    from flex_cache import RefreshAheadScheduler
+    scheduler = RefreshAheadScheduler(min_hits=1, lead_time=1, interval=0.1)
+
+    @cache.cache(ttl=2, refresh_ahead=scheduler)
+    def add_ahead(arg1, arg2):
+        return add_func(arg1, arg2)
+
+    v = list(add_ahead(1, 2))
+    assert add_ahead(1, 2) == v
+    time.sleep(1.3)
+    # recomputed before it expired, so the caller does not miss
+    refreshed = add_ahead(1, 2)
+    assert isinstance(refreshed, list) and refreshed != v
+    scheduler.close()
+
+
+def test_metrics_evictions():
+    cache = RedisCache(redis_client=client, metrics=True)
+
+    @cache.cache(limit=2)
+    def add_metered_limit(arg1, arg2):
+        return add_func(arg1, arg2)
+
+    add_metered_limit.invalidate_all()
+    for i in range(4):
+        add_metered_limit(i, i)
+    add_metered_limit(3, 3)
+    info = add_metered_limit.cache_info()
+    assert (info.hits, info.misses, info.sets, info.evictions) == (1, 4, 4, 2)
+    assert info.write.count == 4
+    assert cache.set('metered_set', 1, limit=2) is None
+
+
+def test_fractional_ttls(cache):
+    @cache.cache(ttl=1, stale_ttl=0.5, tags='fractional')
+    def add_fractional(arg1, arg2):
+        return add_func(arg1, arg2)
+
+    v = list(add_fractional(1, 2))
+    assert add_fractional(1, 2) == v
+    key = add_fractional.instance.get_key((1, 2), {})
+    assert 1000 < client.pttl(key) <= 1500
+    assert 1000 < client.pttl(add_fractional.instance.keys_key) <= 1500
+    assert 1000 < client.pttl('rc:tag:fractional') <= 1500
@@ -0,0 +1,171 @@
+import uuid
+import time
+
+from redis import StrictRedis
+from flex_cache import TieredCache, MemCache, RedisCache, init_cache_from_settings
+
+import pytest
+
+
+redis_host = "redis-test-host"
+client = StrictRedis(host=redis_host, decode_responses=True)
+
+
+@pytest.fixture(scope="session", autouse=True)
+def clear_cache(request):
+    client.flushall()
+
+
+@pytest.fixture()
+def cache():
+    cache = TieredCache(MemCache(max_entries=100), RedisCache(redis_client=client))
+    yield cache
+    cache.close()
+
+
+def add_func(n1, n2):
+    """ Add function
+    Add n1 to n2 and return a uuid4 unique verifier
+
+    Returns:
+        tuple(int, str(uuid.uuid4))
+    """
+    return n1 + n2, str(uuid.uuid4())
+
+
+def wait_for(condition, timeout=2):
+    deadline = time.time() + timeout
+    while not condition() and time.time() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+
+def test_basic_check(cache):
+    @cache.cache()
+    def add_basic(arg1, arg2):
+        return add_func(arg1, arg2)
+
+    r_3_4, v_3_4 = add_basic(3, 4)
+    r_3_4_cached, v_3_4_cached = add_basic(3, 4)
+    r_5_5, v_5_5 = add_basic(5, 5)
+
+    assert 7 == r_3_4 == r_3_4_cached and v_3_4 == v_3_4_cached
+    assert 10 == r_5_5 and v_5_5 != r_3_4
+    # both tiers hold the value
+    key = add_basic.instance.get_key((3, 4), {})
+    assert client.get(key) is not None
+    assert key in cache._cache[0]._cache
+
+
+def test_promote(cache):
+    @cache.cache(namespace='tiered_promote')
+    def add_promote(arg1, arg2):
+        return add_func(arg1, arg2)
+
+    r_3_4, v_3_4 = add_promote(3, 4)
+    key = add_promote.instance.get_key((3, 4), {})
+    del cache._cache[0]._cache[key]  # drop from L1 - eg. evicted
+    assert v_3_4 == add_promote(3, 4)[1]
+    assert key in cache._cache[0]._cache
+
+
+def test_l1_ttl():
+    cache = TieredCache(MemCache(), RedisCache(redis_client=client), l1_ttl=1)
+
+    @cache.cache(ttl=3600)
+    def add_l1_ttl(arg1, arg2):
+        return add_func(arg1, arg2)
+
+    r_3_4, v_3_4 = add_l1_ttl(3, 4)
+    key = add_l1_ttl.instance.get_key((3, 4), {})
+    time.sleep(1.5)
+    assert cache._cache[0]._cache.get(key) is None
+    assert v_3_4 == add_l1_ttl(3, 4)[1]
+    cache.close()
+
+
+def test_invalidate_broadcast(cache):
+    # another process, with its own L1, sharing the same redis
+    other = TieredCache(MemCache(), RedisCache(redis_client=client))
+
+    def add_broadcast(arg1, arg2):
+        return add_func(arg1, arg2)
+
+    mine = cache.cache(namespace='tiered_broadcast')(add_broadcast)
+    theirs = other.cache(namespace='tiered_broadcast')(add_broadcast)
+    r_3_4, v_3_4 = mine(3, 4)
+    r_4_4, v_4_4 = mine(4, 4)
+    assert v_3_4 == theirs(3, 4)[1] and v_4_4 == theirs(4, 4)[1]
+    key = mine.instance.get_key((3, 4), {})
+    assert key in other._cache[0]._cache
+
+    mine.invalidate(3, 4)
+    assert wait_for(lambda: key not in other._cache[0]._cache)
+    assert v_3_4 != theirs(3, 4)[1]
+
+    mine.invalidate_all()
+    assert wait_for(lambda: len(other._cache[0]._cache) == 0)
+    other.close()
+
+
+def test_basecache_setget(cache):
+    cache.set('setget', 'basic', namespace='base')
+    assert 'basic' == cache.get('setget', namespace='base')
+    cache.invalidate('setget', namespace='base')
+    assert cache.get('setget', namespace='base') is None
+
+
+def test_basic_mget(cache):
+    @cache.cache()
+    def add_basic_get(arg1, arg2):
+        return add_func(arg1, arg2)
+
+    r_3_4, v_3_4 = cache.mget({"fn": add_basic_get, "args": (3, 4)})[0]
+    r2_3_4, v2_3_4 = add_basic_get(3, 4)
+
+    assert r_3_4 == r2_3_4 and v_3_4 == v2_3_4
+
+
+def test_init_from_settings():
+    cache = init_cache_from_settings({'type': 'TieredCache', 'redis_host': redis_host, 'tiered_l1_max_entries': 2})
+    assert isinstance(cache._cache[0], MemCache) and isinstance(cache._cache[1], RedisCache)
+    assert cache._cache[0]._cache.max_entries == 2
+    cache.close()
+
+
+def test_tags(cache):
+    @cache.cache(tags=lambda customer, item: [f'customer:{customer}'])
+    def get_order(customer, item):
+        return add_func(customer, item)
+
+    @cache.cache(tags='catalog', namespace='tags_catalog')
+    def get_price(item):
+        return add_func(item, 0)
+
+    @cache.cache(tags=lambda customer: ['catalog', f'customer:{customer}'])
+    def get_profile(customer):
+        return add_func(customer, 1)
+
+    o1, o2, price, profile = get_order(1, 10), get_order(2, 10), get_price(10), get_profile(1)
+    cache.invalidate_tags('customer:1')
+    assert get_order(1, 10)[1] != o1[1]
+    assert get_order(2, 10)[1] == o2[1]
+    assert get_price(10)[1] == price[1]
+    assert get_profile(1)[1] != profile[1]
+
+    profile = get_profile(1)
+    cache.invalidate_tags('catalog', 'unknown')
+    assert get_price(10)[1] != price[1]
+    assert get_profile(1)[1] != profile[1]
+    assert get_order(2, 10)[1] == o2[1]
+
+    # values computed by mget are tagged too
+    o3 = cache.mget({"fn": get_order, "args": (3, 10)})[0]
+    assert get_order(3, 10)[1] == o3[1]
+    cache.invalidate_tags('customer:3')
+    assert get_order(3, 10)[1] != o3[1]
+
+
+def test_stale_ttl_unsupported(cache):
+    with pytest.raises(ValueError):
+        cache.cache(ttl=10, stale_ttl=5)